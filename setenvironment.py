@@ -79,3 +79,13 @@ registration_basestring = api['registration_basestring']
 image_basestring_original = api['image_basestring_original']
 image_basestring_large = api['image_basestring_large']
 personal_regObs_app_token = api['personal_regObs_app_token']
+
+# Set request variables. Older config files may not have these, so defaults are given.
+web_api_max_workers = api.get('web_api_max_workers', 8)
+http_pool_connections = api.get('http_pool_connections', 10)     # hosts with a pool of kept alive connections
+http_pool_maxsize = api.get('http_pool_maxsize', 32)             # connections kept alive pr host
+http_connect_timeout = api.get('http_connect_timeout', 10)       # seconds
+http_read_timeout = api.get('http_read_timeout', 120)            # seconds
+http_cache = api.get('http_cache', True)                         # responds are cached in local storage
+http_cache_max_age_forecast = api.get('http_cache_max_age_forecast', 3600)  # seconds, for the current season
+http_cache_max_size = api.get('http_cache_max_size', 500)                  # megabytes, oldest are deleted when over
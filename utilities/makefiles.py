@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+"""Handles writing of files in local storage which other threads or processes may be reading at the same time."""
+
+import os as os
+import threading as threading
+
+__author__ = 'raek'
+
+
+def write_atomically(file_name, write, mode='wb', encoding=None):
+    """Writes a file in one move. The content is written to a temporary file next to it, which is then moved in
+    place with os.replace. A file being replaced is whole until the new is, and others reading it never see a half
+    written file. If writing fails the temporary file is removed and the old file is left as it was.
+
+    :param file_name:   [string] File to write, with path.
+    :param write:       [function] Takes the open temporary file and writes the content to it.
+    :param mode:        [string] 'wb' or 'w'
+    :param encoding:    [string] Eg. 'utf-8' when mode is 'w'.
+
+    Ex of use: write_atomically(file_name, lambda f: pickle.dump(data, f))
+    """
+
+    temp_file_name = '{0}.{1}.{2}.tmp'.format(file_name, os.getpid(), threading.get_ident())
+
+    try:
+        with open(temp_file_name, mode, encoding=encoding) as f:
+            write(f)
+        os.replace(temp_file_name, file_name)
+
+    finally:
+        if os.path.exists(temp_file_name):
+            os.remove(temp_file_name)
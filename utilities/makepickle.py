@@ -1,14 +1,47 @@
 # -*- coding: utf-8 -*-
 """Handles pickling and unpickling for storing data."""
 
+import contextlib as contextlib
+import gc as gc
 import pickle as pickle
+import threading as threading
+from utilities import makefiles as mf
 from utilities import makelogs as ml
 
 __author__ = 'raek'
 
+_gc_lock = threading.Lock()
+_gc_pauses = 0              # number of unpickles going on which have paused the garbage collector
+_gc_was_enabled = False     # if the garbage collector was on before the first of them paused it
+
+
+@contextlib.contextmanager
+def _gc_paused():
+    """Pauses the garbage collector while in the with block. The collector is process wide, so unpickles in several
+    threads at the same time are counted. The first to start turns it off and the last to finish turns it back on,
+    if it was on to begin with."""
+
+    global _gc_pauses, _gc_was_enabled
+
+    with _gc_lock:
+        if _gc_pauses == 0:
+            _gc_was_enabled = gc.isenabled()
+            gc.disable()
+        _gc_pauses += 1
+
+    try:
+        yield
+
+    finally:
+        with _gc_lock:
+            _gc_pauses -= 1
+            if _gc_pauses == 0 and _gc_was_enabled:
+                gc.enable()
+
 
 def pickle_anything(something_to_pickle, file_name_and_path, print_message=True):
-    """Pickles anything.
+    """Pickles anything. The pickle is written to a temporary file which is then moved in place, so a file being
+    replaced is whole until the new is, and others reading it never see a half written file.
 
     :param something_to_pickle:
     :param file_name_and_path:
@@ -16,7 +49,8 @@ def pickle_anything(something_to_pickle, file_name_and_path, print_message=True)
     :return:
     """
 
-    pickle.dump(something_to_pickle, open(file_name_and_path, 'wb'))
+    mf.write_atomically(file_name_and_path,
+                        lambda f: pickle.dump(something_to_pickle, f, protocol=pickle.HIGHEST_PROTOCOL))
 
     if print_message is True:
         ml.log_and_print("[info] makepickle.py -> pickle_anything: {0} pickled.".format(file_name_and_path))
@@ -30,7 +64,11 @@ def unpickle_anything(file_name_and_path, print_message=True):
     :return something_to_unpickle:
     """
 
-    something_to_unpickle = pickle.load( open(file_name_and_path, 'rb') )
+    # Unpickling makes lots of objects and the garbage collector would go through them over and over while they
+    # are made. None are garbage, so it is paused.
+    with _gc_paused():
+        with open(file_name_and_path, 'rb') as f:
+            something_to_unpickle = pickle.load(f)
 
     if print_message is True:
         ml.log_and_print("[info] makepickle.py -> unpickle_anything: {0} unpickled.".format(file_name_and_path))
@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+"""Handles refreshing of locally stored data in the background. Data that is old is used while a new copy is
+requested, and the new replaces the old when it is got."""
+
+import threading as threading
+from utilities import makelogs as ml
+
+__author__ = 'raek'
+
+_refreshing = set()
+_refreshing_lock = threading.Lock()
+
+
+def refresh_in_background(key, refresh, args=()):
+    """Starts a thread calling refresh(*args), unless a refresh of the same key is already running.
+
+    The thread is a daemon and does not keep the process alive. Data refreshed this way should be written in one
+    move (see makefiles.write_atomically), so a refresh stopped when the process exits leaves the old as it was.
+    It is then refreshed again the next time it is found to be old.
+
+    :param key:         [string] What is refreshed, eg. a file name. Only one refresh pr key runs at a time.
+    :param refresh:     [function] Requests the data and stores it. Should handle its own errors.
+    :param args:        [tuple] Arguments to refresh.
+    :return:            [bool] True if a refresh was started.
+    """
+
+    with _refreshing_lock:
+        if key in _refreshing:
+            return False
+        _refreshing.add(key)
+
+    def _refresh():
+        try:
+            refresh(*args)
+        finally:
+            with _refreshing_lock:
+                _refreshing.discard(key)
+
+    ml.log_and_print('[info] makerefresh.py -> refresh_in_background: Refreshing {0} in the background.'.format(key))
+    threading.Thread(target=_refresh, name='refresh {0}'.format(key), daemon=True).start()
+
+    return True
@@ -0,0 +1,456 @@
+# -*- coding: utf-8 -*-
+"""Handles requests to the api's. All requests go through one process wide session which keeps connections to
+each host alive, so paging and repeated queries do not pay for a new TCP and TLS handshake every time. A request
+that fails is tried again after a wait that grows for each attempt.
+
+Json responds may be cached in local storage. The cache is keyed on the request, so the same query asked again
+from another script is read from disk. Data on seasons that are over do not expire. Only responds with the http
+status OK and the keys expected are cached."""
+
+import asyncio as asyncio
+import datetime as dt
+import hashlib as hashlib
+import json as json
+import os as os
+import random as random
+import sys as sys
+import threading as threading
+import time as time
+import requests as requests
+from requests.adapters import HTTPAdapter
+from utilities import makefiles as mf
+from utilities import makelogs as ml
+import setenvironment as env
+
+__author__ = 'raek'
+
+_session = None
+_session_lock = threading.Lock()
+_timeout = (env.http_connect_timeout, env.http_read_timeout)
+
+_cache_folder = '{0}httpcache/'.format(env.local_storage)
+# The webapi is not here. Its queries in the current season are not cached, see cache_max_age.
+_cache_max_age_pr_endpoint = {'forecast': env.http_cache_max_age_forecast}
+_cache_stats = {'hits': 0, 'misses': 0, 'writes': 0}
+_cache_stats_lock = threading.Lock()
+_prune_every = 200      # writes between each time the cache is pruned. The first write in a process prunes.
+_prune_lock = threading.Lock()
+
+
+def _make_session(pool_connections, pool_maxsize):
+    """Makes a requests.Session with a keep-alive connection pool pr host and gzip negotiation.
+
+    :param pool_connections:    [int] Number of hosts to keep a connection pool for.
+    :param pool_maxsize:        [int] Max number of connections kept open to each host.
+    :return:                    [requests.Session]
+    """
+
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_connections, pool_maxsize=pool_maxsize)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    session.headers.update({'Accept-Encoding': 'gzip, deflate'})
+
+    return session
+
+
+def get_session():
+    """Returns the process wide session. It is made on first use with the pool sizes given in the api config."""
+
+    global _session
+
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                _session = _make_session(env.http_pool_connections, env.http_pool_maxsize)
+
+    return _session
+
+
+def configure_session(pool_connections=None, pool_maxsize=None, connect_timeout=None, read_timeout=None):
+    """Replaces the process wide session with one using new pool sizes and/or sets new default timeouts.
+    Parameters not given keep the values from the api config.
+
+    :param pool_connections:    [int] Number of hosts to keep a connection pool for.
+    :param pool_maxsize:        [int] Max number of connections kept open to each host. Should not be less than the
+                                number of threads requesting at the same time.
+    :param connect_timeout:     [float] Seconds to wait for a connection to the host.
+    :param read_timeout:        [float] Seconds to wait for the host to send data.
+    """
+
+    global _session, _timeout
+
+    if pool_connections is None:
+        pool_connections = env.http_pool_connections
+    if pool_maxsize is None:
+        pool_maxsize = env.http_pool_maxsize
+    if connect_timeout is None:
+        connect_timeout = _timeout[0]
+    if read_timeout is None:
+        read_timeout = _timeout[1]
+
+    with _session_lock:
+        _session = _make_session(pool_connections, pool_maxsize)
+        _timeout = (connect_timeout, read_timeout)
+
+
+def get(url, **kwargs):
+    """Same as requests.get, but through the shared session and with the default timeout if none is given."""
+
+    kwargs.setdefault('timeout', _timeout)
+    return get_session().get(url, **kwargs)
+
+
+def post(url, **kwargs):
+    """Same as requests.post, but through the shared session and with the default timeout if none is given."""
+
+    kwargs.setdefault('timeout', _timeout)
+    return get_session().post(url, **kwargs)
+
+
+def check_responds(data, url='', required_type=None, required_keys=None):
+    """Raises ConnectionError if the json decoded responds is not of the type expected or is without the keys
+    expected. Eg. an error message given with http status OK. Raised as a connection error so the request is tried
+    again and the responds is not cached.
+
+    :param data:            The json decoded responds.
+    :param url:             [string] Used in the error message.
+    :param required_type:   [type] Eg. list. None requires nothing.
+    :param required_keys:   [list of strings] Keys the responds must have. Requires a dict. None requires nothing.
+    """
+
+    if required_keys is not None:
+        required_type = dict
+
+    if required_type is not None and not isinstance(data, required_type):
+        raise ConnectionError('Responds from {0} is not a {1}'.format(url, required_type.__name__))
+
+    if required_keys is not None and any(k not in data for k in required_keys):
+        raise ConnectionError('Responds from {0} without {1}'.format(url, required_keys))
+
+
+def get_json(url, max_age=0, required_type=None, required_keys=None, **kwargs):
+    """Same as get(url).json(), but the responds is read from the cache if a copy younger than max_age is found.
+    A new responds is written to the cache.
+
+    :param url:             [string]
+    :param max_age:         [int] Seconds. None never expires and 0 does not use the cache. See cache_max_age.
+    :param required_type:   [type] Type the responds must have. See check_responds.
+    :param required_keys:   [list of strings] Keys the responds must have. See check_responds.
+    :return:                The json decoded responds.
+    """
+
+    data = read_cache('GET', url, max_age=max_age)
+
+    if data is None:
+        r = get(url, **kwargs)
+        if r.status_code > 299:
+            raise ConnectionError('http {0} {1}'.format(r.status_code, r.reason))
+        data = r.json()
+        check_responds(data, url, required_type=required_type, required_keys=required_keys)
+        write_cache('GET', url, data, max_age=max_age)
+
+    return data
+
+
+def post_json(url, body, max_age=0, required_type=None, required_keys=None, **kwargs):
+    """Same as post(url, json=body).json(), but the responds is read from the cache if a copy younger than max_age
+    is found. A new responds is written to the cache.
+
+    :param url:             [string]
+    :param body:            [dict] Posted as json.
+    :param max_age:         [int] Seconds. None never expires and 0 does not use the cache. See cache_max_age.
+    :param required_type:   [type] Type the responds must have. See check_responds.
+    :param required_keys:   [list of strings] Keys the responds must have. See check_responds.
+    :return:                The json decoded responds.
+    """
+
+    data = read_cache('POST', url, body=body, max_age=max_age)
+
+    if data is None:
+        r = post(url, json=body, **kwargs)
+        if r.status_code > 299:
+            raise ConnectionError('http {0} {1}'.format(r.status_code, r.reason))
+        data = r.json()
+        check_responds(data, url, required_type=required_type, required_keys=required_keys)
+        write_cache('POST', url, data, body=body, max_age=max_age)
+
+    return data
+
+
+# Fields other than the ..Name fields with values repeated on most forecasts.
+_repeated_fields = frozenset(['Author', 'DangerLevel', 'EmergencyWarning', 'ValidExpositions', 'ValidFrom', 'ValidTo'])
+
+
+def intern_names(data, fields=_repeated_fields):
+    """Dictionary encoding of json from the api's. Strings in fields ending with Name, eg. ForecastRegionName,
+    NickName or the names of KDV elements (..TName), and in the given fields are interned, as are all keys.
+
+    The same name then is one shared string object. This saves memory on large data sets, pickles store each name
+    only once and equality checks on names become a pointer comparison.
+
+    The dictionaries and lists are changed in place. Keys keep their order.
+
+    :param data:    [dict or list] Json decoded.
+    :param fields:  [set of strings] Other fields with values to intern.
+    :return:        The same data as given.
+    """
+
+    if isinstance(data, dict):
+        # Keys can not be replaced in place. If any is not interned, all are put back in the same order.
+        keys = list(data)
+        if any(sys.intern(key) is not key for key in keys):
+            for key in keys:
+                data[sys.intern(key)] = data.pop(key)
+
+        for key, value in data.items():
+            if isinstance(value, str):
+                if key.endswith('Name') or key in fields:
+                    data[key] = sys.intern(value)
+            elif isinstance(value, (dict, list)):
+                intern_names(value, fields)
+
+    elif isinstance(data, list):
+        for d in data:
+            if isinstance(d, (dict, list)):
+                intern_names(d, fields)
+
+    return data
+
+
+def _season_start(date):
+    """The 1st of september starting the season (sept to sept) the date is in."""
+
+    if date.month >= 9:
+        return dt.date(date.year, 9, 1)
+    else:
+        return dt.date(date.year - 1, 9, 1)
+
+
+def cache_max_age(endpoint, to_date=None):
+    """How old a cached responds may be and still be used.
+
+    Requests ending before the current season do not change and never expire. The current season is taken as the
+    one 30 days ago, so late changes to the season just ended are picked up. Else the max age of the endpoint, as
+    given in the api config, is used.
+
+    The webapi is paged and each page is cached by itself. In the current season new registrations shift the
+    offsets, so a cached page can not be put together with pages got later. Webapi queries in the current season
+    are therefore not cached.
+
+    :param endpoint:    [string] 'webapi' or 'forecast'
+    :param to_date:     [date or string as yyyy-mm-dd] Last date requested. None is open ended.
+    :return:            [int] Seconds. None never expires and 0 does not use the cache.
+    """
+
+    if not env.http_cache:
+        return 0
+
+    if isinstance(to_date, str):
+        to_date = dt.datetime.strptime(to_date[0:10], '%Y-%m-%d').date()
+    elif isinstance(to_date, dt.datetime):
+        to_date = to_date.date()
+
+    if to_date is not None and to_date < _season_start(dt.date.today() - dt.timedelta(days=30)):
+        return None
+
+    return _cache_max_age_pr_endpoint.get(endpoint, 0)
+
+
+def _cache_file_name(method, url, body=None):
+    """The cache is content addressed. The file name is a hash of the request and the api versions."""
+
+    request = json.dumps([method, url, body, env.web_api_version, env.forecast_api_version], sort_keys=True,
+                         default=str)
+    key = hashlib.sha1(request.encode('utf-8')).hexdigest()
+
+    return '{0}{1}.json'.format(_cache_folder, key)
+
+
+def _add_to_cache_stats(stat):
+    with _cache_stats_lock:
+        _cache_stats[stat] += 1
+        return _cache_stats[stat]
+
+
+def read_cache(method, url, body=None, max_age=0):
+    """Reads a responds from the cache.
+
+    :param method:      [string] 'GET' or 'POST'
+    :param url:         [string]
+    :param body:        [dict] Posted as json.
+    :param max_age:     [int] Seconds. None never expires and 0 does not use the cache.
+    :return:            The json decoded responds, or None if not in the cache or too old.
+    """
+
+    if max_age == 0:
+        return None
+
+    file_name = _cache_file_name(method, url, body)
+
+    try:
+        if max_age is None or time.time() - os.path.getmtime(file_name) < max_age:
+            with open(file_name, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            _add_to_cache_stats('hits')
+            return data
+
+    except (OSError, ValueError):
+        pass
+
+    _add_to_cache_stats('misses')
+    return None
+
+
+def write_cache(method, url, data, body=None, max_age=0):
+    """Writes a responds to the cache. The file is written to a temporary file first and then moved in place, so
+    other threads or processes reading the cache never see a half written file.
+
+    Empty responds are not cached. They may be a glitch on the api, and a past season would then be empty for good.
+    Every _prune_every writes, the cache is pruned to the max size given in the api config.
+
+    :param method:      [string] 'GET' or 'POST'
+    :param url:         [string]
+    :param data:        The json decoded responds.
+    :param body:        [dict] Posted as json.
+    :param max_age:     [int] Seconds. 0 does not use the cache and nothing is written.
+    """
+
+    if max_age == 0 or not data:
+        return
+
+    file_name = _cache_file_name(method, url, body)
+
+    try:
+        os.makedirs(_cache_folder, exist_ok=True)
+        mf.write_atomically(file_name, lambda f: json.dump(data, f), mode='w', encoding='utf-8')
+        writes = _add_to_cache_stats('writes')
+        if writes % _prune_every == 1:
+            prune_cache()
+
+    except OSError:
+        error_msg = sys.exc_info()[1]
+        ml.log_and_print('[warning] makerequests.py -> write_cache: Could not cache {0}: {1}'.format(url, error_msg))
+
+
+def cache_stats():
+    """Returns the number of hits, misses and writes on the cache since the start of the process.
+
+    :return:    [dict] {'hits': int, 'misses': int, 'writes': int, 'hit_rate': float}
+    """
+
+    with _cache_stats_lock:
+        stats = dict(_cache_stats)
+
+    lookups = stats['hits'] + stats['misses']
+    stats['hit_rate'] = stats['hits'] / lookups if lookups > 0 else 0.
+
+    return stats
+
+
+def prune_cache(max_size=None):
+    """Deletes the oldest cached responds until the cache is no larger than max_size. Files are aged by when they
+    were written.
+
+    :param max_size:    [float] Megabytes. Default None uses the max size given in the api config.
+    """
+
+    if max_size is None:
+        max_size = env.http_cache_max_size
+
+    with _prune_lock:
+        try:
+            cached_files = []
+            for entry in os.scandir(_cache_folder):
+                stat = entry.stat()
+                cached_files.append((stat.st_mtime, stat.st_size, entry.path))
+        except OSError:
+            return
+
+        cache_size = sum(size for _, size, _ in cached_files)
+        max_bytes = max_size * 1024 * 1024
+        number_deleted = 0
+
+        for _, size, file_name in sorted(cached_files):
+            if cache_size <= max_bytes:
+                break
+            try:
+                os.remove(file_name)
+                cache_size -= size
+                number_deleted += 1
+            except OSError:
+                pass
+
+    if number_deleted > 0:
+        ml.log_and_print('[info] makerequests.py -> prune_cache: {0} old responds deleted. Cache is {1:.0f} MB.'
+                         .format(number_deleted, cache_size / 1024 / 1024))
+
+
+def clear_cache():
+    """Deletes all cached responds."""
+
+    if os.path.exists(_cache_folder):
+        for file_name in os.listdir(_cache_folder):
+            os.remove('{0}{1}'.format(_cache_folder, file_name))
+
+
+def request_with_retry(make_request, description='', max_attempts=5, backoff=1., max_backoff=30.):
+    """Calls make_request until it returns without an exception or until max_attempts is used up. Only the failing
+    request is repeated, so the caller keeps whatever it got before the failure.
+
+    Between attempts there is an exponential backoff with jitter, i.e. a random wait between 0 and
+    backoff * 2^(attempt-1) seconds, but never longer than max_backoff.
+
+    :param make_request:    [function] Takes no arguments and returns the result of one request. Raise to signal failure.
+    :param description:     [string] What is requested. Used in the log.
+    :param max_attempts:    [int] Attempt the same request # times before giving up.
+    :param backoff:         [float] Seconds. Base of the exponential backoff.
+    :param max_backoff:     [float] Seconds. Upper limit of the wait between two attempts.
+
+    :return result, attempts:   The result of make_request, or None if all attempts failed, and the number of
+                                attempts used.
+
+    Ex of use: warnings, attempts = request_with_retry(lambda: get(url).json(), description=url)
+    """
+
+    for attempt in range(1, max_attempts + 1):
+        try:
+            return make_request(), attempt
+
+        except Exception:
+            error_msg = sys.exc_info()[0]
+            ml.log_and_print('[error] makerequests.py -> request_with_retry: EXCEPTION on attempt {0} of {1} for {2}: {3}'
+                             .format(attempt, max_attempts, description, error_msg))
+
+            if attempt < max_attempts:
+                time.sleep(_backoff_wait(attempt, backoff, max_backoff))
+
+    return None, max_attempts
+
+
+async def arequest_with_retry(make_request, description='', max_attempts=5, backoff=1., max_backoff=30.):
+    """Same as request_with_retry, but make_request is a coroutine function and the wait between attempts does not
+    block the event loop.
+
+    Ex of use: warnings, attempts = await arequest_with_retry(lambda: get_json(session, url), description=url)
+    """
+
+    for attempt in range(1, max_attempts + 1):
+        try:
+            return await make_request(), attempt
+
+        except Exception:
+            error_msg = sys.exc_info()[0]
+            ml.log_and_print('[error] makerequests.py -> arequest_with_retry: EXCEPTION on attempt {0} of {1} for {2}: {3}'
+                             .format(attempt, max_attempts, description, error_msg))
+
+            if attempt < max_attempts:
+                await asyncio.sleep(_backoff_wait(attempt, backoff, max_backoff))
+
+    return None, max_attempts
+
+
+def _backoff_wait(attempt, backoff, max_backoff):
+    """Seconds to wait after a failed attempt. Random between 0 and backoff * 2^(attempt-1), but not over max_backoff."""
+
+    return random.uniform(0, min(max_backoff, backoff * 2 ** (attempt - 1)))
@@ -0,0 +1,237 @@
+# -*- coding: utf-8 -*-
+"""Async versions of the methods requesting the regObs webapi and the forecast api's. They are for use in an
+event loop, e.g. in a service, where many queries are multiplexed on one loop instead of blocking a thread each.
+
+Queries, urls and the putting together of the results are the same as in getobservations and getforecastapi.
+The number of requests at the same time is bounded by a semaphore.
+
+Requires aiohttp:
+pip install aiohttp
+"""
+
+import asyncio as asyncio
+from utilities import makelogs as ml
+from utilities import makerequests as mr
+from varsomdata import getobservations as go
+from varsomdata import getforecastapi as gfa
+import setenvironment as env
+
+__author__ = 'raek'
+
+
+def make_client_session():
+    """Makes an aiohttp.ClientSession with the pool size and timeouts given in the api config. Pass it to several
+    calls to share the connections, and close it when done.
+
+    :return:    [aiohttp.ClientSession]
+
+    Ex of use:  async with make_client_session() as session:
+                    observations = await aget_data(from_date='2019-01-01', to_date='2019-01-31', session=session)
+    """
+
+    import aiohttp as aiohttp
+
+    connector = aiohttp.TCPConnector(limit_per_host=env.http_pool_maxsize)
+    timeout = aiohttp.ClientTimeout(sock_connect=env.http_connect_timeout, sock_read=env.http_read_timeout)
+
+    return aiohttp.ClientSession(connector=connector, timeout=timeout)
+
+
+async def _request_json(session, semaphore, method, url, max_attempts=5, max_age=0, json=None, required_type=None,
+                        required_keys=None, **kwargs):
+    """Requests url and returns the json in the responds. The semaphore is held during the request, but not while
+    waiting to try again after a failed attempt. The response cache is shared with the sync methods.
+
+    :return responds, attempts:     The json decoded responds, or None if all attempts failed, and the attempts used.
+                                    Attempts is None if the responds was read from the cache.
+    """
+
+    data = mr.read_cache(method, url, body=json, max_age=max_age)
+    if data is not None:
+        return data, None
+
+    async def _request():
+        async with semaphore:
+            async with session.request(method, url, json=json, **kwargs) as r:
+                if r.status > 299:
+                    raise ConnectionError('http {0} {1}'.format(r.status, r.reason))
+                data = await r.json(content_type=None)
+                mr.check_responds(data, url, required_type=required_type, required_keys=required_keys)
+                return data
+
+    data, attempts = await mr.arequest_with_retry(_request, description=url, max_attempts=max_attempts)
+    if data is not None:
+        mr.write_cache(method, url, data, body=json, max_age=max_age)
+
+    return data, attempts
+
+
+async def _make_one_request(session, semaphore, rssquery, output='List', recursive_count=5):
+    """Async version of getobservations._make_one_request. Collects all the pages of one query in offset order.
+    Raises ConnectionError if a page fails recursive_count times."""
+
+    url = go._search_url()
+    max_age = mr.cache_max_age('webapi', rssquery['ToDate'])
+
+    async def _request_page(offset):
+        responds, attempts = await _request_json(session, semaphore, 'POST', url, max_attempts=recursive_count,
+                                                 max_age=max_age, json=dict(rssquery, Offset=offset),
+                                                 required_keys=['Results', 'TotalMatches'])
+        if responds is not None:
+            mr.intern_names(responds)
+        return responds
+
+    responds = await _request_page(0)
+
+    if responds is None:
+        ml.log_and_print("[error] getasync.py -> _make_one_request: first page failed {0} times. Giving up."
+                         .format(recursive_count))
+        raise ConnectionError('First page of the webapi query failed {0} times'.format(recursive_count))
+
+    if output == 'Count nest':
+        return [responds['TotalMatches']]
+
+    # The first page tells how many there are. The rest are requested at the same time and gather keeps the order.
+    offsets = go._page_offsets(responds)
+    pages = await asyncio.gather(*[_request_page(offset) for offset in offsets])
+
+    data = list(responds['Results'])
+    failed_offsets = []
+    for offset, page in zip(offsets, pages):
+        if page is None:
+            failed_offsets.append(offset)
+        else:
+            data += page['Results']
+
+    if failed_offsets:
+        ml.log_and_print("[error] getasync.py -> _make_one_request: gave up on offsets {0}".format(failed_offsets))
+        raise ConnectionError('Pages on offsets {0} of the webapi query failed {1} times'
+                              .format(failed_offsets, recursive_count))
+
+    return data
+
+
+async def aget_data(from_date=None, to_date=None, registration_types=None, reg_ids=None, region_ids=None,
+                    location_id=None, observer_ids=None, observer_nick=None, observer_competence=None, group_id=None,
+                    output='List', geohazard_tids=None, lang_key=1, shard_by=None,
+                    max_workers=env.web_api_max_workers, session=None):
+    """Async version of getobservations.get_data. Parameters and output are the same. Raises ConnectionError if a
+    page of the webapi fails on all attempts.
+
+    :param max_workers:         [int] Max number of requests to the webapi at the same time.
+    :param session:             [aiohttp.ClientSession] Default None makes a session for this call only.
+
+    :return:                    [list or int] Depending on output requested.
+    """
+
+    rssqueries = go._make_rssqueries(
+        from_date=from_date, to_date=to_date, registration_types=registration_types, reg_ids=reg_ids,
+        region_ids=region_ids, location_id=location_id, observer_ids=observer_ids, observer_nick=observer_nick,
+        observer_competence=observer_competence, group_id=group_id, geohazard_tids=geohazard_tids, lang_key=lang_key,
+        shard_by=shard_by)
+
+    own_session = session is None
+    if own_session:
+        session = make_client_session()
+
+    try:
+        semaphore = asyncio.Semaphore(max_workers)
+        queried_data = await asyncio.gather(
+            *[_make_one_request(session, semaphore, rssquery, output=output) for rssquery in rssqueries])
+    finally:
+        if own_session:
+            await session.close()
+
+    return go._make_output(queried_data, output=output, method_name='aget_data')
+
+
+async def _get_warnings_as_json(urls, keys, from_date, to_date, method_name, recursive_count, max_workers, session,
+                                headers=None):
+    """Part of the aget_*_warnings_as_json methods. Requests all urls at the same time and puts together the
+    warnings in the order of the urls."""
+
+    max_age = mr.cache_max_age('forecast', to_date)
+    own_session = session is None
+    if own_session:
+        session = make_client_session()
+
+    try:
+        semaphore = asyncio.Semaphore(max_workers)
+        results = await asyncio.gather(
+            *[_request_json(session, semaphore, 'GET', url, max_attempts=recursive_count, max_age=max_age,
+                            required_type=list, headers=headers)
+              for url in urls])
+    finally:
+        if own_session:
+            await session.close()
+
+    warnings_ = []
+    for key, (warnings_key, attempts) in zip(keys, results):
+        if warnings_key is None:
+            ml.log_and_print('[error] getasync.py -> {0}: Gave up after {1} attempts for {2} in {3} to {4}'
+                             .format(method_name, attempts, key, from_date, to_date))
+        else:
+            source = 'from cache' if attempts is None else '{0} attempts'.format(attempts)
+            ml.log_and_print('[info] getasync.py -> {0}: {1} warnings found for {2} in {3} to {4} ({5})'
+                             .format(method_name, len(warnings_key), key, from_date, to_date, source))
+            warnings_ += mr.intern_names(warnings_key)
+
+    return warnings_
+
+
+async def aget_avalanche_warnings_as_json(region_ids, from_date, to_date, lang_key=1, recursive_count=5,
+                                          max_workers=env.web_api_max_workers, session=None):
+    """Async version of getforecastapi.get_avalanche_warnings_as_json. All regions are requested at the same time.
+
+    :param region_ids:      [int or list of ints]       RegionID as given in the forecast api [1-99] or in regObs [101-199]
+    :param from_date:       [date or string as yyyy-mm-dd]
+    :param to_date:         [date or string as yyyy-mm-dd]
+    :param lang_key:        [int]                       Language setting. 1 is norwegian and 2 is english.
+    :param recursive_count  [int]                       by default attempt the same request # times before giving up
+    :param max_workers:     [int]                       Max number of requests at the same time.
+    :param session:         [aiohttp.ClientSession]     Default None makes a session for this call only.
+
+    :return warnings:       [list of dict]              As given on the api
+    """
+
+    # If input isn't a list, make it so
+    if not isinstance(region_ids, list):
+        region_ids = [region_ids]
+
+    urls = [gfa._make_avalanche_warnings_url(region_id, from_date, to_date, lang_key) for region_id in region_ids]
+
+    return await _get_warnings_as_json(urls, region_ids, from_date, to_date, 'aget_avalanche_warnings_as_json',
+                                       recursive_count, max_workers, session)
+
+
+async def aget_landslide_warnings_as_json(municipality, from_date, to_date, lang_key=1, recursive_count=5,
+                                          max_workers=env.web_api_max_workers, session=None):
+    """Async version of getforecastapi.get_landslide_warnings_as_json. All municipalities are requested at the
+    same time.
+
+    :param municipality:    [int or list of ints]       Municipality numbers
+    :param from_date:       [date or string as yyyy-mm-dd]
+    :param to_date:         [date or string as yyyy-mm-dd]
+    :param lang_key:        [int]                       Language setting. 1 is norwegian and 2 is english.
+    :param recursive_count  [int]                       by default attempt the same request # times before giving up
+    :param max_workers:     [int]                       Max number of requests at the same time.
+    :param session:         [aiohttp.ClientSession]     Default None makes a session for this call only.
+
+    :return warnings:       [list of dict]              As given on the api
+    """
+
+    # If input isn't a list, make it so
+    if not isinstance(municipality, list):
+        municipality = [municipality]
+
+    urls = [gfa._make_landslide_warnings_url(m, from_date, to_date, lang_key) for m in municipality]
+
+    return await _get_warnings_as_json(urls, municipality, from_date, to_date, 'aget_landslide_warnings_as_json',
+                                       recursive_count, max_workers, session, headers=gfa._landslide_api_headers)
+
+
+if __name__ == "__main__":
+
+    warnings = asyncio.run(aget_avalanche_warnings_as_json([3022, 3014], '2018-12-01', '2018-12-21'))
+
+    pass
@@ -3,6 +3,7 @@
 the data is from.)"""
 
 import datetime as dt
+from concurrent.futures import ThreadPoolExecutor
 from varsomdata import getobservations as go
 from varsomdata import getforecastapi as gfa
 from varsomdata import varsomclasses as vc
@@ -131,13 +132,13 @@ def get_observed_dangers(region_ids, from_date, to_date, lang_key=1):
     :return:
     """
 
-    evaluations_1 = go.get_avalanche_evaluation(region_ids=region_ids, from_date=from_date, to_date=to_date, lang_key=lang_key)
-    evaluations_2 = go.get_avalanche_evaluation_2(region_ids=region_ids, from_date=from_date, to_date=to_date, lang_key=lang_key)
-    evaluations_3 = go.get_avalanche_evaluation_3(region_ids=region_ids, from_date=from_date, to_date=to_date, lang_key=lang_key)
+    # All three evaluation forms in one query. 28 is AvalancheEvaluation, 30 AvalancheEvaluation2 and 31 AvalancheEvaluation3.
+    evaluations = go.get_observations_by_type([28, 30, 31], region_ids=region_ids, from_date=from_date, to_date=to_date,
+                                              lang_key=lang_key)
 
-    conform_evals_1 = _make_eval1_conform(evaluations_1)
-    conform_evals_2 = _make_eval2_conform(evaluations_2)
-    conform_evals_3 = _make_eval3_conform(evaluations_3)
+    conform_evals_1 = _make_eval1_conform(evaluations[28])
+    conform_evals_2 = _make_eval2_conform(evaluations[30])
+    conform_evals_3 = _make_eval3_conform(evaluations[31])
 
     evaluations = conform_evals_1 + conform_evals_2 + conform_evals_3
 
@@ -173,6 +174,24 @@ def get_forecasted_dangers(region_ids, from_date, to_date, include_ikke_vurdert=
     return region_warnings
 
 
+def index_dangers_by_date_and_region(dangers):
+    """Indexes dangers on date and regObs region id, so the danger on a day in a region is looked up directly
+    instead of looping through all of them. If several dangers have the same date and region, the last one is kept.
+
+    :param dangers:     [list of AvalancheDanger]
+    :return:            [dict] {(date, region_regobs_id): AvalancheDanger}
+
+    Ex of use: dangers_index = index_dangers_by_date_and_region(warnings)
+               danger = dangers_index.get((problem.date, problem.region_regobs_id))
+    """
+
+    dangers_index = {}
+    for d in dangers:
+        dangers_index[(d.date, d.region_regobs_id)] = d
+
+    return dangers_index
+
+
 def get_all_dangers(region_ids, from_date, to_date, lang_key=1):
     """Method does NOT include avalanche problems. Gets all avalanche dangers dangers, both forecasted and
     observed in given regions for a given time period.
@@ -184,8 +203,11 @@ def get_all_dangers(region_ids, from_date, to_date, lang_key=1):
     :return:
     """
 
-    warnings = get_forecasted_dangers(region_ids, from_date, to_date, lang_key=lang_key)
-    observed = get_observed_dangers(region_ids, from_date, to_date, lang_key=lang_key)
+    # The forecast api and regObs are requested at the same time.
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        warnings_future = executor.submit(get_forecasted_dangers, region_ids, from_date, to_date, lang_key=lang_key)
+        observed = get_observed_dangers(region_ids, from_date, to_date, lang_key=lang_key)
+        warnings = warnings_future.result()
 
     all_dangers = warnings + observed
 
@@ -12,6 +12,7 @@ import datetime as dt
 import numpy as np
 from varsomdata import varsomclasses as vc
 from utilities import makelogs as ml
+from utilities import makerequests as mr
 import setenvironment as env
 
 __author__ = 'raek'
@@ -620,7 +621,7 @@ class MountainWeather:
             raise
 
         api_url = f"http://h-web03.nve.no/APSapi/TimeSeriesReader.svc/MountainWeather/{region_id}/{d}/en/true"
-        api_return = requests.get(api_url).json()
+        api_return = mr.get(api_url).json()
 
         self.region_id = region_id
         self.date_valid = date_valid
@@ -740,6 +741,32 @@ class MountainWeather:
         except TypeError:
             ml.log_and_print('getforecastapi.py -> MountainWeather.from_dict(): TypeError source.')
 
+
+def _make_avalanche_warnings_url(region_id, from_date, to_date, lang_key=1):
+    """Makes the url for requesting avalanche warnings on one region on the forecast api.
+
+    :param region_id:       [int]                       RegionID as given in the forecast api [1-99] or in regObs [101-199]
+    :param from_date:       [date or string as yyyy-mm-dd]
+    :param to_date:         [date or string as yyyy-mm-dd]
+    :param lang_key:        [int]                       Language setting. 1 is norwegian and 2 is english.
+    :return url:            [string]
+    """
+
+    # In nov 2016 we updated all regions to have ids in th 3000´s. GIS and regObs equal.
+    # Before that GIS har numbers 0-99 and regObs 100-199. Messy..
+    # Also, new api dont support old forecasts due to model changes.
+    if region_id > 100 and region_id < 3000:
+        region_id = region_id - 100
+        api_version = env.forecast_api_version_archive
+    else:
+        api_version = env.forecast_api_version
+
+    url = "http://api01.nve.no/hydrology/forecast/avalanche/{4}/api/AvalancheWarningByRegion/Detail/{0}/{3}/{1}/{2}"\
+        .format(region_id, from_date, to_date, lang_key, api_version)
+
+    return url
+
+
 # Todo: rename to get_avalanche_dangers_as_json
 def get_avalanche_warnings_as_json(region_ids, from_date, to_date, lang_key=1, recursive_count=5):
     """Selects warnings and returns the json structured as given on the api.
@@ -761,39 +788,24 @@ def get_avalanche_warnings_as_json(region_ids, from_date, to_date, lang_key=1, r
         region_ids = [region_ids]
 
     warnings_ = []
-    recursive_count_default = recursive_count   # need the default for later
+    max_age = mr.cache_max_age('forecast', to_date)
 
     for region_id in region_ids:
 
-        if len(region_ids) > 1:
-            # if we are looping the initial list make sure each item gets the recursive count default
-            recursive_count = recursive_count_default
-
-        # In nov 2016 we updated all regions to have ids in th 3000´s. GIS and regObs equal.
-        # Before that GIS har numbers 0-99 and regObs 100-199. Messy..
-        # Also, new api dont support old forecasts due to model changes.
-        if region_id > 100 and region_id < 3000:
-            region_id = region_id - 100
-            api_version = env.forecast_api_version_archive
-        else:
-            api_version = env.forecast_api_version
-
-        url = "http://api01.nve.no/hydrology/forecast/avalanche/{4}/api/AvalancheWarningByRegion/Detail/{0}/{3}/{1}/{2}"\
-            .format(region_id, from_date, to_date, lang_key, api_version)
+        url = _make_avalanche_warnings_url(region_id, from_date, to_date, lang_key)
 
-        # If at first you don't succeed, try and try again.
-        try:
-            warnings_region = requests.get(url).json()
-            ml.log_and_print('[info] getforecastapi.py -> get_avalanche_warnings_as_json: {0} warnings found for {1} in {2} to {3}'
-                             .format(len(warnings_region), region_id, from_date, to_date))
-            warnings_ += warnings_region
+        # If at first you don't succeed, try and try again. Only this region is requested again.
+        warnings_region, attempts = mr.request_with_retry(
+            lambda: mr.get_json(url, max_age=max_age, required_type=list), description=url,
+            max_attempts=recursive_count)
 
-        except:
-            ml.log_and_print('[error] getforecastapi.py -> get_avalanche_warnings_as_json: EXCEPTION. RECURSIVE COUNT {0} for {1} in {2} to {3}'
-                             .format(recursive_count, region_id, from_date, to_date))
-            if recursive_count > 1:
-                recursive_count -= 1        # count down
-                warnings_ += get_avalanche_warnings_as_json(region_id, from_date, to_date, lang_key, recursive_count=recursive_count)
+        if warnings_region is None:
+            ml.log_and_print('[error] getforecastapi.py -> get_avalanche_warnings_as_json: Gave up after {0} attempts for {1} in {2} to {3}'
+                             .format(attempts, region_id, from_date, to_date))
+        else:
+            ml.log_and_print('[info] getforecastapi.py -> get_avalanche_warnings_as_json: {0} warnings found for {1} in {2} to {3} ({4} attempts)'
+                             .format(len(warnings_region), region_id, from_date, to_date, attempts))
+            warnings_ += mr.intern_names(warnings_region)
 
     return warnings_
 
@@ -961,6 +973,25 @@ def get_valid_regids(region_id, from_date, to_date):
     return valid_regids
 
 
+_landslide_api_headers = {'Content-Type': 'application/json'}
+
+
+def _make_landslide_warnings_url(municipality, from_date, to_date, lang_key=1):
+    """Makes the url for requesting landslide warnings on one municipality on the forecast api.
+
+    :param municipality:    [int]                       Municipality number
+    :param from_date:       [date or string as yyyy-mm-dd]
+    :param to_date:         [date or string as yyyy-mm-dd]
+    :param lang_key:        [int]                       Language setting. 1 is norwegian and 2 is english.
+    :return url:            [string]
+    """
+
+    landslide_api_base_url = 'https://api01.nve.no/hydrology/forecast/landslide/v1.0.5/api'
+    url = landslide_api_base_url + '/Warning/Municipality/{0}/{1}/{2}/{3}'.format(municipality, lang_key, from_date, to_date)
+
+    return url
+
+
 def get_landslide_warnings_as_json(municipality, from_date, to_date, lang_key=1, recursive_count=5):
     """Selects landslide warnings and returns the json structured as given on the api as dict objects.
 
@@ -980,31 +1011,25 @@ def get_landslide_warnings_as_json(municipality, from_date, to_date, lang_key=1,
         municipality = [municipality]
 
     landslide_warnings = []
-    recursive_count_default = recursive_count   # need the default for later
+    max_age = mr.cache_max_age('forecast', to_date)
 
     for m in municipality:
 
-        if len(municipality) > 1:
-            # if we are looping the initial list make sure each item gets the recursive count default
-            recursive_count = recursive_count_default
+        url = _make_landslide_warnings_url(m, from_date, to_date, lang_key)
 
-        landslide_api_base_url = 'https://api01.nve.no/hydrology/forecast/landslide/v1.0.5/api'
-        headers = {'Content-Type': 'application/json'}
-        url = landslide_api_base_url + '/Warning/Municipality/{0}/{1}/{2}/{3}'.format(m, lang_key, from_date, to_date)
+        # If at first you don't succeed, try and try again. Only this municipality is requested again.
+        landslide_warnings_municipal, attempts = mr.request_with_retry(
+            lambda: mr.get_json(url, max_age=max_age, required_type=list, headers=_landslide_api_headers),
+            description=url,
+            max_attempts=recursive_count)
 
-        # If at first you don't succeed, try and try again.
-        try:
-            landslide_warnings_municipal = requests.get(url, headers=headers).json()
-            ml.log_and_print('[info] getforecastapi.py -> get_landslide_warnings_as_json: {0} warnings found for {1} in {2} to {3}'
-                             .format(len(landslide_warnings_municipal), m, from_date, to_date))
-            landslide_warnings += landslide_warnings_municipal
-
-        except:
-            ml.log_and_print('[error] getforecastapi.py -> get_avalanche_warnings_as_json: EXCEPTION. RECURSIVE COUNT {0} for {1} in {2} to {3}'
-                             .format(recursive_count, m, from_date, to_date))
-            if recursive_count > 1:
-                recursive_count -= 1        # count down
-                landslide_warnings += get_landslide_warnings_as_json(m, from_date, to_date, lang_key, recursive_count=recursive_count)
+        if landslide_warnings_municipal is None:
+            ml.log_and_print('[error] getforecastapi.py -> get_landslide_warnings_as_json: Gave up after {0} attempts for {1} in {2} to {3}'
+                             .format(attempts, m, from_date, to_date))
+        else:
+            ml.log_and_print('[info] getforecastapi.py -> get_landslide_warnings_as_json: {0} warnings found for {1} in {2} to {3} ({4} attempts)'
+                             .format(len(landslide_warnings_municipal), m, from_date, to_date, attempts))
+            landslide_warnings += mr.intern_names(landslide_warnings_municipal)
 
     return landslide_warnings
 
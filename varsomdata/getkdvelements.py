@@ -6,22 +6,40 @@ This is also the contents of drop down choices in regObs. It is useful to have a
 these tables.
 """
 
-import requests
 import os.path
-import datetime as dt
+import sys as sys
+import threading as threading
+import time as time
 import collections
+from concurrent.futures import ThreadPoolExecutor
 from utilities import makepickle as mp
 from utilities import makelogs as ml
+from utilities import makerefresh as mrf
+from utilities import makerequests as mr
 from varsomdata import varsomclasses as vc
 import setenvironment as env
 
 __author__ = 'raek'
 
 
+# Views in use are kept in memory for the process. <key, value> = <view, (ordered_dict, expires)> where expires is
+# the time (in seconds since epoch) the copy gets too old and is refreshed.
+_kdv_registry = {}
+_kdv_registry_lock = threading.Lock()    # held when the registry is changed
+_kdv_max_file_age = 3   # days
+_kdv_retry_after = 600  # seconds to wait before trying again when a refresh failed
+
+
 def get_kdv(view):
     """Imports a view view from regObs and returns a dictionary with <key, value> = <ID, Name>
     An view is requested from the regObs api if the pickle file is older than 3 days.
 
+    Views are kept in memory once read, so only the first call in a process reads local storage or requests the
+    api. The dictionary returned is shared between calls and should not be changed.
+
+    A view older than 3 days is returned at once and refreshed in a background thread. The refreshed view replaces
+    the old when it is got. If the api is down, the old is kept and used.
+
     :param view:    [string]    kdv view
     :return dict:   {}          view as a dictionary
 
@@ -30,70 +48,120 @@ def get_kdv(view):
     http://api.nve.no/hydrology/regobs/v0.9.4/OData.svc/ForecastRegionKDV?$filter=Langkey%20eq%201%20&$format=json
     """
 
-    kdv_file_name = '{0}{1}.pickle'.format(env.local_storage, view)
-    dict = {}
+    registered = _kdv_registry.get(view)
 
-    if os.path.exists(kdv_file_name):
+    if registered is not None:
+        ordered_dict, expires = registered
 
-        max_file_age = 3
-        # file_date_seconds = os.path.getctime(kdv_file_name)
-        file_date_seconds = os.path.getmtime(kdv_file_name)
-        file_date_datetime = dt.datetime.fromtimestamp(file_date_seconds)
-        file_date_limit = dt.datetime.now() - dt.timedelta(days=max_file_age)
+    else:
+        kdv_file_name = '{0}{1}.pickle'.format(env.local_storage, view)
 
-        if file_date_datetime < file_date_limit:
-            ml.log_and_print("[info] getkdvelements.py -> get_kdv: Old xKDV. Removing file from local storage: {0}".format(kdv_file_name))
-            os.remove(kdv_file_name)
-            ordered_dict = get_kdv(view)
-            mp.pickle_anything(ordered_dict, kdv_file_name)
-        else:
+        if os.path.exists(kdv_file_name):
             # ml.log_and_print("[info] getkdvelements.py -> get_kdv: Getting KDV from local storage: {0}".format(kdv_file_name))
             ordered_dict = mp.unpickle_anything(kdv_file_name, print_message=False)
+            expires = os.path.getmtime(kdv_file_name) + _kdv_max_file_age * 24 * 3600
+        else:
+            # Nothing to use while waiting.
+            ordered_dict = _request_kdv(view)
+            expires = time.time() + _kdv_max_file_age * 24 * 3600
+
+        with _kdv_registry_lock:
+            _kdv_registry[view] = (ordered_dict, expires)
+
+    if expires <= time.time():
+        mrf.refresh_in_background('{0}{1}.pickle'.format(env.local_storage, view), _refresh_kdv, (view,))
+
+    return ordered_dict
 
-    else:
 
-        filter = 'filter=Langkey%20eq%201'
+def _refresh_kdv(view):
+    """Part of get_kdv. Run in the background by makerefresh. Requests a view and replaces the one in memory. If
+    the request fails, the old is used a while more before it is tried again."""
 
-        if 'TripTypeKDV' in view:
-            filter = 'filter=LangKey%20eq%201'
+    try:
+        ordered_dict = _request_kdv(view)
+        if not ordered_dict:
+            raise ValueError('No elements in {0}'.format(view))
+        with _kdv_registry_lock:
+            _kdv_registry[view] = (ordered_dict, time.time() + _kdv_max_file_age * 24 * 3600)
 
-        url = 'https://api.nve.no/hydrology/regobs/{0}/OData.svc/{1}?${2}&$format=json'.format(env.odata_version, view, filter)
-        lang_key = 1
+    except Exception:
+        error_msg = sys.exc_info()[0]
+        ml.log_and_print("[warning] getkdvelements.py -> _refresh_kdv: Could not refresh {0}. Using the old. {1}"
+                         .format(view, error_msg))
+        with _kdv_registry_lock:
+            if view in _kdv_registry:
+                _kdv_registry[view] = (_kdv_registry[view][0], time.time() + _kdv_retry_after)
 
-        print("getkdvelements.py -> get_kdv: Getting KDV from URL: {0}".format(url))
-        kdv = requests.get(url).json()
 
-        for a in kdv['d']['results']:
-            try:
-                sort_order = a['SortOrder']
-                is_active = a['IsActive']
+def _request_kdv(view):
+    """Part of get_kdv. Requests a view from the regObs api and stores it in local storage."""
 
-                if 'AvalCauseKDV' in url and 9 < int(a['ID']) < 26:      # this table gets special treatment. Short names are in description and long names are in Name.
-                    id = int(a['ID'])
-                    name = a['Description']
-                    description = a['Name']
-                elif 'TripTypeKDV' in view:
-                    id = int(a['TripTypeTID'])
-                    name = a['Name']
-                    description = a['Descr']
-                else:
-                    id = int(a['ID'])
-                    name = a['Name']
-                    description = a['Description']
+    kdv_file_name = '{0}{1}.pickle'.format(env.local_storage, view)
+    dict = {}
 
-                dict[id] = vc.KDVelement(id, sort_order, is_active, name, description, lang_key)
+    filter = 'filter=Langkey%20eq%201'
 
-            except (RuntimeError, TypeError, NameError):
-                pass
+    if 'TripTypeKDV' in view:
+        filter = 'filter=LangKey%20eq%201'
 
-        ordered_dict = collections.OrderedDict(sorted(dict.items()))
+    url = 'https://api.nve.no/hydrology/regobs/{0}/OData.svc/{1}?${2}&$format=json'.format(env.odata_version, view, filter)
+    lang_key = 1
+
+    print("getkdvelements.py -> get_kdv: Getting KDV from URL: {0}".format(url))
+    kdv = mr.get(url).json()
+
+    for a in kdv['d']['results']:
+        try:
+            sort_order = a['SortOrder']
+            is_active = a['IsActive']
+
+            if 'AvalCauseKDV' in url and 9 < int(a['ID']) < 26:      # this table gets special treatment. Short names are in description and long names are in Name.
+                id = int(a['ID'])
+                name = a['Description']
+                description = a['Name']
+            elif 'TripTypeKDV' in view:
+                id = int(a['TripTypeTID'])
+                name = a['Name']
+                description = a['Descr']
+            else:
+                id = int(a['ID'])
+                name = a['Name']
+                description = a['Description']
+
+            dict[id] = vc.KDVelement(id, sort_order, is_active, name, description, lang_key)
+
+        except (RuntimeError, TypeError, NameError):
+            pass
+
+    ordered_dict = collections.OrderedDict(sorted(dict.items()))
+
+    # An empty view is not stored over one that may be good.
+    if ordered_dict:
         mp.pickle_anything(ordered_dict, kdv_file_name)
 
     return ordered_dict
 
 
+def preload(views):
+    """Reads views to memory before they are used. Views not already in memory are read, or requested from the
+    regObs api, at the same time. Views in memory that are old are refreshed in the background as in get_kdv.
+
+    :param views:   [list of strings] kdv views
+
+    Ex of use: preload(['ForecastRegionKDV', 'TripTypeKDV'])
+    """
+
+    missing_views = [v for v in views if v not in _kdv_registry]
+
+    if missing_views:
+        with ThreadPoolExecutor(max_workers=max(1, min(env.web_api_max_workers, len(missing_views)))) as executor:
+            list(executor.map(get_kdv, missing_views))
+
+
 def get_name(view, tid):
-    """Gets a Name-value given ist value and the KDV-view it belongs to.
+    """Gets a Name-value given ist value and the KDV-view it belongs to. The view is read once and kept in memory,
+    so looking up names for many objects is a dictionary lookup each.
 
     :param view:    [string]
     :param tid:     [int]
@@ -5,14 +5,16 @@ for retrieving info on trips submitted.
 """
 
 import sys as sys
+import os as os
 import datetime as dt
-import requests as requests
 import csv as csv
+import json as json
+from concurrent.futures import ThreadPoolExecutor
 import setenvironment as env
 from varsomdata import getobservations as go
 from varsomdata import getdangers as gd
 from varsomdata import getkdvelements as kdv
-from utilities import fencoding as fe, readfile as rf, makelogs as ml
+from utilities import fencoding as fe, readfile as rf, makelogs as ml, makerequests as mr, makepickle as mp
 
 __author__ = 'raek'
 
@@ -87,7 +89,7 @@ def get_trip(from_date, to_date, geohazard_tid=None, output='List'):
 
     ml.log_and_print('[info] getmisc.py -> get_trip: ..to {0}'.format(url), print_it=True)
 
-    result = requests.get(url).json()
+    result = mr.get(url).json()
     data = result['d']['results']
 
     # if more than 1000 elements are requested, odata truncates data to 1000. We do more requests
@@ -134,7 +136,7 @@ def get_observer_group_member(group_id=None, output='List'):
         url = 'http://api.nve.no/hydrology/regobs/{0}/Odata.svc/ObserverGroupMemberV/?$filter=ObserverGroupID%20eq%20{1}&$format=json'.format(env.odata_version, group_id)
     ml.log_and_print("[info] getmisc.py -> get_observer_group_member: {0}".format(url))
 
-    result = requests.get(url).json()
+    result = mr.get(url).json()
     data = result['d']['results']
     data_out = [ObserverGroupMember(d) for d in data]
 
@@ -197,7 +199,7 @@ def get_registration(from_date, to_date, output='List', geohazard_tid=None, appl
     url = 'http://api.nve.no/hydrology/regobs/{0}/Odata.svc/{1}/?$filter={2}&$format=json'.format(env.odata_version, 'Registration', odata_filter)
     ml.log_and_print("[info] getmisc.py -> get_registration: ..to {0}".format(url), print_it=True)
 
-    result = requests.get(url).json()
+    result = mr.get(url).json()
     data = result['d']['results']
 
     # if more than 1000 elements are requested, odata truncates data to 1000. We do more requests
@@ -221,6 +223,35 @@ def get_registration(from_date, to_date, output='List', geohazard_tid=None, appl
         return data_out
 
 
+def get_deleted_reg_ids(deleted_since):
+    """Gets the RegIDs of registrations deleted after a given time. Deleted registrations are not found by
+    searching the webapi, so this is how locally stored observations find the ones to take out.
+
+    Raises ConnectionError if the odata api does not answer with a list of registrations, so an error is not taken
+    as no deletions.
+
+    :param deleted_since:   [datetime]
+    :return:                [set of ints] RegIDs
+    """
+
+    odata_filter = "DeletedDate gt datetime'{0}'".format(deleted_since.strftime('%Y-%m-%dT%H:%M:%S'))
+    url = 'http://api.nve.no/hydrology/regobs/{0}/Odata.svc/{1}/?$filter={2}&$select=RegID&$format=json'.format(
+        env.odata_version, 'Registration', odata_filter)
+
+    # odata returns max 1000 elements pr request. Skip those already got until a request returns less.
+    data = []
+    while True:
+        result = mr.get_json('{0}&$skip={1}'.format(url, len(data)), required_keys=['d'])
+        mr.check_responds(result['d'], url, required_keys=['results'])
+        data += result['d']['results']
+        if len(result['d']['results']) < 1000:
+            break
+
+    ml.log_and_print("[info] getmisc.py -> get_deleted_reg_ids: {0} deleted since {1}".format(len(data), deleted_since))
+
+    return set(int(d['RegID']) for d in data)
+
+
 class ObsLocation:
     """Object of an ObsLocation."""
 
@@ -252,7 +283,7 @@ def get_obs_location(from_date, to_date):
     odata_filter = "DtRegTime gt datetime'{0}' and DtRegTime lt datetime'{1}' and langkey eq 1".format(from_date, to_date)
 
     url = 'http://api.nve.no/hydrology/regobs/{0}/Odata.svc/ObsLocationV/?$filter={1}&$format=json'.format(env.odata_version, odata_filter)
-    result = requests.get(url).json()
+    result = mr.get(url).json()
     data = result['d']['results']
     ml.log_and_print('[info] getmisc.py -> get_obs_location: {0}'.format(url))
 
@@ -345,10 +376,13 @@ def get_avalanche_index(from_date, to_date, region_ids=None, observer_ids=None):
     """
 
     # get all data
-    avalanche_activities = go.get_avalanche_activity(from_date, to_date, region_ids=region_ids, observer_ids=observer_ids)
-    avalanche_activities_2 = go.get_avalanche_activity_2(from_date, to_date, region_ids=region_ids, observer_ids=observer_ids)
-    avalanches = go.get_avalanche(from_date, to_date, region_ids=region_ids, observer_ids=observer_ids)
-    danger_signs = go.get_danger_sign(from_date, to_date, region_ids=region_ids, observer_ids=observer_ids)
+    # get all data in one query. 27 is AvalancheActivityObs, 33 AvalancheActivityObs2, 26 AvalancheObs and 13 DangerSign.
+    observations = go.get_observations_by_type([27, 33, 26, 13], from_date, to_date, region_ids=region_ids,
+                                               observer_ids=observer_ids)
+    avalanche_activities = observations[27]
+    avalanche_activities_2 = observations[33]
+    avalanches = observations[26]
+    danger_signs = observations[13]
 
     # get index definition
     index_definition = rf.read_configuration_file('{0}aval_dl_order_of_size_and_num.csv'.format(env.matrix_configurations), AvalancheIndex)
@@ -404,15 +438,15 @@ def get_observer_v():
     """
 
     url_1 = 'http://api.nve.no/hydrology/regobs/{0}/Odata.svc/ObserverV/?$filter=ObserverId lt 3000&$format=json'.format(env.odata_version)
-    result_1 = requests.get(url_1).json()
+    result_1 = mr.get(url_1).json()
     data_1 = result_1['d']['results']
 
     url_2 = 'http://api.nve.no/hydrology/regobs/{0}/Odata.svc/ObserverV/?$filter=ObserverId gt 2999 and ObserverId lt 6000&$format=json'.format(env.odata_version)
-    result_2 = requests.get(url_2).json()
+    result_2 = mr.get(url_2).json()
     data_2 = result_2['d']['results']
 
     url_3 = 'http://api.nve.no/hydrology/regobs/{0}/Odata.svc/ObserverV/?$filter=ObserverId gt 5999&$format=json'.format(env.odata_version)
-    result_3 = requests.get(url_3).json()
+    result_3 = mr.get(url_3).json()
     data_3 = result_3['d']['results']
 
     data = data_1 + data_2 + data_3
@@ -660,31 +694,95 @@ def get_forecast_region_for_regid(reg_id):
     return region_id, region_name, observation
 
 
-def get_forecast_region_for_coordinate(utm33x, utm33y, year):
-    """Maps an observation to the forecast regions used at the time the observation was made
+def _get_observations_for_regid(reg_id):
+    """Part of get_forecast_regions_for_regids. The observations on one regid, or None if the request fails."""
 
-    :param utm33x:
-    :param utm33y:
-    :param year:
-    :return region_id, region_name:
+    try:
+        return go.get_data_as_class(reg_ids=reg_id, max_workers=1)
 
-    ## osx requires
-    pip install pyshp
-    pip install shapely
+    except:
+        error_msg = sys.exc_info()[0]
+        ml.log_and_print('[error] getmisc.py -> get_forecast_regions_for_regids: Exception on RegID={0}: {1}.'
+                         .format(reg_id, error_msg))
+        return None
 
-    ## windows requires
-    pip install pyshp
-    conda config --add channels conda-forge
-    conda install shapely
 
-    Helpful pages
-    https://pypi.python.org/pypi/pyshp
-    https://chrishavlin.wordpress.com/2016/11/16/shapefiles-tutorial/
-    https://streamhacker.com/2010/03/23/python-point-in-polygon-shapely/
+def _has_coordinate_and_date(observation):
+    """Part of get_forecast_regions_for_regids. True if the observation can be mapped to a forecast region."""
+
+    try:
+        float(observation.UTMEast)
+        float(observation.UTMNorth)
+        observation.DtObsTime.date()
+        return True
+
+    except (TypeError, ValueError, AttributeError):
+        return False
+
+
+def get_forecast_regions_for_regids(reg_ids, max_workers=env.web_api_max_workers):
+    """Same as get_forecast_region_for_regid, but for many regids. The observations are requested at the same time
+    and all their coordinates are mapped to forecast regions in one go.
+
+    As with get_forecast_region_for_regid, failures are logged and do not stop the others. A regid where the request
+    fails or the observation has no usable coordinates or date is left out.
+
+    :param reg_ids:         [list of ints] regids in regObs
+    :param max_workers:     [int] Max number of requests to the webapi at the same time.
+    :return:                [dict] {RegID: (ForecastRegionTID, ForecastRegionName, observation)} with the
+                            observation as an Observation object. Regids not found in regObs are not included.
+
+    Ex of use: regions_by_regid = get_forecast_regions_for_regids([130548, 130328])
+               region_id, region_name, observation = regions_by_regid[130548]
     """
 
-    from shapely import geometry as gty
-    import shapefile as sf
+    if not reg_ids:
+        return {}
+
+    # One request pr regid, so a failing request only affects its own regid.
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(reg_ids)))) as executor:
+        observations_pr_regid = list(executor.map(_get_observations_for_regid, reg_ids))
+
+    failed_reg_ids = {r for r, found in zip(reg_ids, observations_pr_regid) if found is None}
+    observations = []
+    for found in observations_pr_regid:
+        for o in found or []:
+            if _has_coordinate_and_date(o):
+                observations.append(o)
+            else:
+                failed_reg_ids.add(o.RegID)
+                ml.log_and_print('[error] getmisc.py -> get_forecast_regions_for_regids: No valid coordinates or date '
+                                 'on RegID={0}.'.format(o.RegID))
+
+    regions_by_regid = {}
+    try:
+        region_ids, region_names = get_forecast_regions_for_coordinates(
+            [o.UTMEast for o in observations], [o.UTMNorth for o in observations],
+            [o.DtObsTime for o in observations])
+
+        for o, region_id, region_name in zip(observations, region_ids, region_names):
+            regions_by_regid[o.RegID] = (int(region_id), region_name, o)
+
+    except:
+        error_msg = sys.exc_info()[0]
+        failed_reg_ids.update(o.RegID for o in observations)
+        ml.log_and_print('[error] getmisc.py -> get_forecast_regions_for_regids: Exception mapping RegID={0} to '
+                         'forecast regions: {1}.'.format(sorted(o.RegID for o in observations), error_msg))
+
+    missing_reg_ids = set(reg_ids) - set(regions_by_regid) - failed_reg_ids
+    if missing_reg_ids:
+        ml.log_and_print('[warning] getmisc.py -> get_forecast_regions_for_regids: No observation on RegID={0}.'
+                         .format(sorted(missing_reg_ids)))
+
+    return regions_by_regid
+
+
+def _get_region_shapes_for_year(year):
+    """The shape file with the forecast regions used in a season and the offset added to its region ids.
+
+    :param year:    [string] Season, eg. '2016-17'
+    :return file_name, id_offset:
+    """
 
     if year == '2012-13':
         # varsling startet januar 2013
@@ -706,29 +804,318 @@ def get_forecast_region_for_coordinate(utm33x, utm33y, year):
         file_name = 'VarslingsOmrF_fra_2016_des'
         id_offset = 0
 
-    shape_file = sf.Reader('{0}{1}'.format(env.forecast_region_shapes, file_name))
-    point = gty.MultiPoint([(utm33x, utm33y)]).convex_hull
-    count = 0
-    region = None
+    return file_name, id_offset
+
+
+class _RegionIndex:
+    """Spatial index on the regions in one shape file. Regions are found by their bounding boxes in an STRtree
+    and only those are tested exactly, with prepared polygons.
+
+    Polygons and records are cached in local storage, so the shape file is read once. The tree and the prepared
+    polygons can not be pickled and are made when the index is loaded."""
+
+    def __init__(self, polygons, records):
+
+        from shapely.prepared import prep
+        from shapely.strtree import STRtree
+
+        self.polygons = polygons
+        self.records = records
+        self.prepared_polygons = [prep(p) for p in polygons]
+        self.tree = STRtree(polygons)
+
+    def find(self, point):
+        """Index of the region containing the point, or None. If more regions contain the point, the last in the
+        shape file is given, as when testing them all in turn."""
+
+        indexes = [i for i in self.tree.query(point) if self.prepared_polygons[i].contains(point)]
+
+        if indexes:
+            return int(max(indexes))
+        else:
+            return None
+
+    def find_all(self, points):
+        """Same as find, but for an array of points in one go. The tree is queried for all points at once and the
+        exact tests are made in the same pass.
+
+        :param points:  [array of shapely Points]
+        :return:        [array of ints] Index of the region containing each point, or -1 where none does.
+        """
+
+        import numpy as np
+
+        point_indexes, region_indexes = self.tree.query(points, predicate='within')
+
+        found = np.full(len(points), -1, dtype=np.int64)
+        np.maximum.at(found, point_indexes, region_indexes)
+
+        return found
+
+
+_region_indexes = {}
+
+
+def _get_region_index(file_name):
+    """Gets the spatial index on a shape file. It is kept in memory once made and cached in local storage until
+    the shape file changes.
+
+    :param file_name:   [string] Shape file in the forecast_region_shapes folder, without extension.
+    :return:            [_RegionIndex]
+    """
+
+    if file_name in _region_indexes:
+        return _region_indexes[file_name]
+
+    from shapely import geometry as gty
+    import shapefile as sf
+
+    shape_file_name = '{0}{1}'.format(env.forecast_region_shapes, file_name)
+    index_file_name = '{0}{1}_regionindex.pickle'.format(env.local_storage, file_name)
 
-    for shape in shape_file.iterShapes():
-        poly = gty.Polygon(shape.points)
-        if point.within(poly):
-            region = shape_file.records()[count]
-        count += 1
+    if os.path.exists(index_file_name) and \
+            os.path.getmtime(index_file_name) > os.path.getmtime('{0}.shp'.format(shape_file_name)):
+        polygons, records = mp.unpickle_anything(index_file_name, print_message=False)
 
-    # records = sf.records()
+    else:
+        shape_file = sf.Reader(shape_file_name)
+        polygons = [gty.Polygon(shape.points) for shape in shape_file.iterShapes()]
+        records = [list(r) for r in shape_file.records()]
+        shape_file.close()
+        mp.pickle_anything((polygons, records), index_file_name)
+
+    region_index = _RegionIndex(polygons, records)
+    _region_indexes[file_name] = region_index
+
+    return region_index
+
+
+class _RegionRaster:
+    """Grid of region indexes over the regions in one shape file. A cell fully inside the regions covering it
+    holds the index the exact test would give for any point in it. Cells crossed by a region border hold -2 and
+    points there are tested exactly in the _RegionIndex. Cells outside all regions hold -1.
+
+    The grid is saved in local storage as a .npy file and opened memory mapped, so only the cells looked up are
+    read from disk."""
+
+    def __init__(self, grid, x0, y0, resolution, region_index):
+        self.grid = grid
+        self.x0 = x0
+        self.y0 = y0
+        self.resolution = resolution
+        self.region_index = region_index
+
+    def find_all(self, utm33x, utm33y):
+        """Same as _RegionIndex.find_all, but most points are found by reading their cell.
+
+        :param utm33x:  [array of floats]
+        :param utm33y:  [array of floats]
+        :return:        [array of ints] Index of the region containing each point, or -1 where none does.
+        """
+
+        import numpy as np
+        import shapely as shapely
+
+        rows = np.floor((utm33y - self.y0) / self.resolution)
+        cols = np.floor((utm33x - self.x0) / self.resolution)
+
+        # Points without coordinates (NaN) are put in cell -1, which is off the grid, so they are not found.
+        rows = np.where(np.isfinite(rows), rows, -1).astype(np.int64)
+        cols = np.where(np.isfinite(cols), cols, -1).astype(np.int64)
+        on_grid = (rows >= 0) & (rows < self.grid.shape[0]) & (cols >= 0) & (cols < self.grid.shape[1])
+
+        found = np.full(len(utm33x), -1, dtype=np.int64)
+        found[on_grid] = self.grid[rows[on_grid], cols[on_grid]]
+
+        on_border = found == -2
+        if on_border.any():
+            found[on_border] = self.region_index.find_all(shapely.points(utm33x[on_border], utm33y[on_border]))
+
+        return found
+
+
+def _make_region_grid(region_index, resolution, rows_pr_chunk=100):
+    """Part of _get_region_raster. Makes the grid of region indexes. The cells are tested against the regions a
+    chunk of rows at a time.
+
+    :return grid, x0, y0:   [2d array of int32] and the lower left corner of the grid.
+    """
+
+    import numpy as np
+    import shapely as shapely
+
+    polygons = np.array(region_index.polygons, dtype=object)
+    x0, y0, x1, y1 = shapely.total_bounds(polygons)
+    num_cols = int(np.ceil((x1 - x0) / resolution))
+    num_rows = int(np.ceil((y1 - y0) / resolution))
+    grid = np.full((num_rows, num_cols), -1, dtype=np.int32)
+
+    cols = np.arange(num_cols)
+    for first_row in range(0, num_rows, rows_pr_chunk):
+        rows = np.arange(first_row, min(first_row + rows_pr_chunk, num_rows))
+        cell_cols, cell_rows = [a.ravel() for a in np.meshgrid(cols, rows)]
+        cells = shapely.box(x0 + cell_cols * resolution, y0 + cell_rows * resolution,
+                            x0 + (cell_cols + 1) * resolution, y0 + (cell_rows + 1) * resolution)
+
+        cell_indexes, polygon_indexes = region_index.tree.query(cells, predicate='intersects')
+        inside = shapely.contains_properly(polygons[polygon_indexes], cells[cell_indexes])
+
+        values = np.full(len(cells), -1, dtype=np.int64)
+        np.maximum.at(values, cell_indexes, polygon_indexes)
+        values[cell_indexes[~inside]] = -2
+
+        grid[cell_rows, cell_cols] = values
+
+    return grid, x0, y0
+
+
+_region_rasters = {}
+
+
+def _get_region_raster(file_name, resolution=1000):
+    """Gets the raster of regions in a shape file. It is kept in memory once made and cached in local storage
+    until the shape file changes.
+
+    :param file_name:   [string] Shape file in the forecast_region_shapes folder, without extension.
+    :param resolution:  [int] Meters. Size of the cells.
+    :return:            [_RegionRaster]
+    """
+
+    import numpy as np
+
+    if (file_name, resolution) in _region_rasters:
+        return _region_rasters[(file_name, resolution)]
+
+    region_index = _get_region_index(file_name)
+
+    shape_file_name = '{0}{1}.shp'.format(env.forecast_region_shapes, file_name)
+    grid_file_name = '{0}{1}_regionraster_{2}m.npy'.format(env.local_storage, file_name, resolution)
+    corner_file_name = '{0}{1}_regionraster_{2}m.json'.format(env.local_storage, file_name, resolution)
+
+    if not (os.path.exists(grid_file_name) and os.path.exists(corner_file_name) and
+            os.path.getmtime(corner_file_name) > os.path.getmtime(shape_file_name)):
+        ml.log_and_print('[info] getmisc.py -> _get_region_raster: Making {0} m raster of {1}'
+                         .format(resolution, file_name))
+        grid, x0, y0 = _make_region_grid(region_index, resolution)
+        np.save(grid_file_name, grid)
+        # The corner is written last and tells the grid is whole.
+        with open(corner_file_name, 'w') as f:
+            json.dump({'x0': x0, 'y0': y0}, f)
+
+    with open(corner_file_name) as f:
+        corner = json.load(f)
+    grid = np.load(grid_file_name, mmap_mode='r')
+
+    region_raster = _RegionRaster(grid, corner['x0'], corner['y0'], resolution, region_index)
+    _region_rasters[(file_name, resolution)] = region_raster
+
+    return region_raster
 
-    if region is None:
+
+def get_forecast_region_for_coordinate(utm33x, utm33y, year):
+    """Maps an observation to the forecast regions used at the time the observation was made
+
+    The regions are looked up in a spatial index made once pr shape file. See _get_region_index.
+
+    :param utm33x:
+    :param utm33y:
+    :param year:
+    :return region_id, region_name:
+
+    ## osx requires
+    pip install pyshp
+    pip install shapely
+
+    ## windows requires
+    pip install pyshp
+    conda config --add channels conda-forge
+    conda install shapely
+
+    Shapely 2.0 or newer is needed for the spatial index.
+
+    Helpful pages
+    https://pypi.python.org/pypi/pyshp
+    https://chrishavlin.wordpress.com/2016/11/16/shapefiles-tutorial/
+    https://streamhacker.com/2010/03/23/python-point-in-polygon-shapely/
+    """
+
+    from shapely import geometry as gty
+
+    file_name, id_offset = _get_region_shapes_for_year(year)
+    region_index = _get_region_index(file_name)
+
+    point = gty.Point(utm33x, utm33y)
+    count = region_index.find(point)
+
+    if count is None:
         region_name = 'Ikke gitt'
         region_id = 0
     else:
+        region = region_index.records[count]
         region_name = region[1]
         region_id = region[0]+id_offset
 
     return region_id, region_name
 
 
+def get_forecast_regions_for_coordinates(utm33x, utm33y, dates, raster_resolution=None):
+    """Maps many observations to the forecast regions used at the time each was made. Same as
+    get_forecast_region_for_coordinate, but the points are grouped on the shape files used in their seasons and each
+    group is looked up in one go.
+
+    :param utm33x:      [list or array of numbers] East coordinates in UTM33
+    :param utm33y:      [list or array of numbers] North coordinates in UTM33
+    :param dates:       [list of dates or datetimes] When each observation was made.
+    :param raster_resolution:   [int] Meters. If given, points are looked up in a raster of the regions with cells
+                        of this size, and only points in cells crossed by a region border are tested exactly.
+                        Answers are the same, but much faster for millions of points. The raster is made the
+                        first time and cached in local storage. Default None tests all points exactly.
+    :return region_ids, region_names:   [array of ints, array of strings] Region 0 and 'Ikke gitt' where not found.
+
+    Ex of use: region_ids, region_names = get_forecast_regions_for_coordinates(
+                    [o.UTMEast for o in obs], [o.UTMNorth for o in obs], [o.DtObsTime for o in obs])
+    """
+
+    import numpy as np
+    import shapely as shapely
+
+    utm33x = np.asarray(utm33x, dtype=float)
+    utm33y = np.asarray(utm33y, dtype=float)
+
+    region_ids = np.zeros(len(utm33x), dtype=np.int64)
+    region_names = np.full(len(utm33x), 'Ikke gitt', dtype=object)
+
+    # Seasons are found once pr date, shape files once pr season, and the points are grouped pr shape file.
+    seasons = {}
+    shapes = {}
+    points_pr_shapes = {}
+    for i, date in enumerate(dates):
+        if isinstance(date, dt.datetime):
+            date = date.date()
+        if date not in seasons:
+            seasons[date] = get_season_from_date(date)
+        if seasons[date] not in shapes:
+            shapes[seasons[date]] = _get_region_shapes_for_year(seasons[date])
+        points_pr_shapes.setdefault(shapes[seasons[date]], []).append(i)
+
+    for (file_name, id_offset), indexes in points_pr_shapes.items():
+        indexes = np.asarray(indexes)
+        region_index = _get_region_index(file_name)
+
+        if raster_resolution:
+            found = _get_region_raster(file_name, raster_resolution).find_all(utm33x[indexes], utm33y[indexes])
+        else:
+            found = region_index.find_all(shapely.points(utm33x[indexes], utm33y[indexes]))
+        records_ids = np.array([r[0] + id_offset for r in region_index.records] + [0], dtype=np.int64)
+        records_names = np.array([r[1] for r in region_index.records] + ['Ikke gitt'], dtype=object)
+
+        # Not found is -1, which is the last element added above.
+        region_ids[indexes] = records_ids[found]
+        region_names[indexes] = records_names[found]
+
+    return region_ids, region_names
+
+
 def get_observer_nicks_given_ids(observer_ids):
 
     all_observers = get_observer_v()
@@ -797,20 +1184,25 @@ def get_varsom_incidents(add_forecast_regions=False, add_observations=False, add
 
     # map incident to forecast region
     if add_forecast_regions:
+
+        # The first regid of each incident gives the region. If observations are added, the other regids are
+        # requested in the same go.
+        reg_ids = [i.regid[0] for i in varsom_incidents if i.regid != []]
+        if add_observations:
+            reg_ids += [reg_id for i in varsom_incidents for reg_id in i.regid[1:]]
+        regions_by_regid = get_forecast_regions_for_regids(list(dict.fromkeys(reg_ids)))
+
         for i in varsom_incidents:
             if i.regid == []:
                 ml.log_and_print("[warning] getmisc.py -> get_varsom_incidents: No regid on incident on {}. No forecast region found.".format(i.date))
             else:
-                region_id, region_name, observation = get_forecast_region_for_regid(i.regid[0])
+                region_id, region_name, observation = regions_by_regid.get(i.regid[0], (None, None, None))
                 i.add_forecast_region(region_id, region_name)
-                print("regid {}: {}".format(i.regid[0], i.date))
 
                 if add_observations:
-                    i.add_observation(observation[0])
-                    if len(i.regid) > 1:
-                        observations = go.get_data_as_class(reg_ids=i.regid[1:])
-                        for o in observations:
-                            i.add_observation(o)
+                    for reg_id in i.regid:
+                        if reg_id in regions_by_regid:
+                            i.add_observation(regions_by_regid[reg_id][2])
 
         if add_forecasts:
             years = ['2014-15', '2015-16', '2016-17', '2017-18', '2018-19']        # the years with data
@@ -821,16 +1213,11 @@ def get_varsom_incidents(add_forecast_regions=False, add_observations=False, add
                 from_date, to_date = get_forecast_dates(y)
                 all_forecasts += gd.get_forecasted_dangers(region_ids, from_date, to_date)
 
+            forecasts_index = gd.index_dangers_by_date_and_region(all_forecasts)
             for i in varsom_incidents:
-                incident_date = i.date
-                incident_region_id = i.region_id
-                print("{}: {}".format(i.location, incident_date))
-                for f in all_forecasts:
-                    forecast_date = f.date
-                    forecast_region_id = f.region_regobs_id
-                    if incident_date == forecast_date:
-                        if incident_region_id == forecast_region_id:
-                            i.add_forecast(f)
+                f = forecasts_index.get((i.date, i.region_id))
+                if f is not None:
+                    i.add_forecast(f)
 
     return varsom_incidents
 
@@ -2,20 +2,30 @@
 """Contains classes and methods for accessing all on the regObs webapi."""
 
 import datetime as dt
+import heapq as heapq
 import requests as requests
 import pandas as pd
-import sys as sys
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache, partial
+from itertools import islice
 from utilities import makelogs as ml
+from utilities import makerequests as mr
 from dateutil.parser import parse as parse
 import setenvironment as env
 
 __author__ = 'raek'
 
 
+@lru_cache(maxsize=2**17)
 def _stringtime_2_datetime(stringtime):
     """Takes in a date as string, both given as unix datetime or normal local time, as string.
     Method returns a normal datetime object.
 
+    The webapi gives iso 8601 times which are parsed by the fast datetime.fromisoformat. Other formats fall back to
+    dateutil. The same times occur again and again in a season (e.g. DtObsTime on all forms in a registration),
+    so results are memoized. Datetimes are immutable and safe to share.
+
     :param stringtime:
     :return:           The date and time as datetime object
     """
@@ -29,37 +39,66 @@ def _stringtime_2_datetime(stringtime):
         date = dt.datetime.fromtimestamp(int(unix_datetime_in_seconds))
 
     else:
-        # if '.' in stringtime:       # though sometimes with seconds given with decimal places
-        #     non_decimal_stringtime = stringtime[0:stringtime.index('.')]
-        #     stringtime = non_decimal_stringtime
-        #
-        # date = dt.datetime.strptime(stringtime, '%Y-%m-%dT%H:%M:%S')
-        date = parse(stringtime)
+        try:
+            date = dt.datetime.fromisoformat(stringtime)
+        except ValueError:
+            # eg. more than 6 decimals on the seconds or a time zone given as Z on older pythons
+            date = parse(stringtime)
 
     return date
 
 
+def _make_column(field, values):
+    """Part of _make_data_frame. Gives a column of values a fitting dtype. Datetimes become datetime64, ints the
+    nullable Int64 and names (fields ending with Name) categorical. Other columns are left to pandas.
+
+    :param field:   [string] Name of the column.
+    :param values:  [list] Values in the column. None is missing.
+    :return:        [list or array like]
+    """
+
+    not_none = [v for v in values if v is not None]
+
+    if len(not_none) == 0:
+        return values
+
+    if all(isinstance(v, dt.date) for v in not_none):
+        try:
+            return pd.to_datetime(values)
+        except (ValueError, TypeError):  # eg. time zone aware mixed with naive
+            return values
+
+    if all(isinstance(v, int) and not isinstance(v, bool) for v in not_none):
+        return pd.array(values, dtype='Int64')
+
+    if field.endswith('Name') and all(isinstance(v, str) for v in not_none):
+        return pd.Categorical(values)
+
+    return values
+
+
 def _make_data_frame(list_of_data):
     """Takes a list of objects and makes a Pandas data frame.
 
+    The values are collected pr attribute and the data frame is made in one go. The objects may be of different
+    classes. Columns are all attributes found, in the order they first occur, and attributes missing on an
+    object are NA. See _make_column for the dtypes given.
+
     :param list_of_data: [list of objects]
     :return:     [data frame]
     """
 
     if len(list_of_data) == 0:
-        data_frame = pd.DataFrame()
-    else:
-        observation_fields = list(list_of_data[0].__dict__.keys())
-        data_frame = pd.DataFrame(columns=observation_fields)
+        return pd.DataFrame()
+
+    attributes = [l._asdict() if type(l) is CompactObservation else vars(l) for l in list_of_data]
+    fields = list(dict.fromkeys(field for a in attributes for field in a))
 
-        i = 0
-        for l in list_of_data:
-            observation_values = list(l.__dict__.values())
-            data_frame.loc[i] = observation_values
-            # data_frame.append(observation_values, ignore_index=True)  # does not work
-            i += 1
+    columns = {}
+    for field in fields:
+        columns[field] = _make_column(field, [a.get(field) for a in attributes])
 
-    return data_frame
+    return pd.DataFrame(columns)
 
 
 def _reg_types_dict(registration_tids=None):
@@ -159,13 +198,26 @@ def _reg_types_dict(registration_tids=None):
                 "[warning] getobservations.py -> _reg_types_dict: RegistrationTID {0} not supported (yet).".format(
                     registration_tid))
 
-    return registration_dicts
+    # Types in the same group are asked for in one entry with all their subtypes.
+    grouped_dicts = {}
+    for registration_dict in registration_dicts:
+        if registration_dict['Id'] in grouped_dicts:
+            sub_types = grouped_dicts[registration_dict['Id']]['SubTypes']
+            sub_types += [s for s in registration_dict['SubTypes'] if s not in sub_types]
+        else:
+            grouped_dicts[registration_dict['Id']] = registration_dict
+
+    return list(grouped_dicts.values())
 
 
-def _make_one_request(from_date=None, to_date=None, reg_id=None, registration_types=None,
-                      region_ids=None, location_id=None, observer_id=None, observer_nick=None, observer_competence=None,
-                      group_id=None, output='List', geohazard_tids=None, lang_key=1, recursive_count=5):
-    """Part of get_data method. Parameters the same except observer_id and reg_id can not be lists."""
+def _make_rssquery(from_date=None, to_date=None, reg_id=None, registration_types=None, region_ids=None,
+                   location_id=None, observer_id=None, observer_nick=None, observer_competence=None, group_id=None,
+                   geohazard_tids=None, lang_key=1, changed_since=None):
+    """Makes the query object posted to the webapi. Parameters the same as get_data except observer_id and reg_id
+    can not be lists.
+
+    :return:    [dict] rssquery with offset 0.
+    """
 
     # Dates in the web-api request are strings
     if isinstance(from_date, dt.date):
@@ -178,9 +230,9 @@ def _make_one_request(from_date=None, to_date=None, reg_id=None, registration_ty
     elif isinstance(to_date, dt.datetime):
         to_date = dt.datetime.strftime(to_date, '%Y-%m-%d')
 
-    data = []  # data from one query
+    if isinstance(changed_since, dt.datetime):
+        changed_since = dt.datetime.strftime(changed_since, '%Y-%m-%dT%H:%M:%S')
 
-    # query object posted in the request
     rssquery = {'LangKey': lang_key,
                 'RegId': reg_id,
                 'ObserverGuid': None,
@@ -194,102 +246,202 @@ def _make_one_request(from_date=None, to_date=None, reg_id=None, registration_ty
                 'LocationId': location_id,
                 'FromDate': from_date,
                 'ToDate': to_date,
+                'FromDtChangeTime': changed_since,
                 'NumberOfRecords': None,  # int
                 'Offset': 0}
 
-    url = 'https://api.nve.no/hydrology/regobs/webapi_{0}/Search/All'.format(env.web_api_version)
-    # url = 'http://tst-h-web03.nve.no/regobswebapi/Search/Rss?geoHazard=0'
-    # url = 'https://api.nve.no/hydrology/demo/regobs/webapi_v3.2/Search/Rss?geoHazard=0'
+    return rssquery
 
-    more_available = True
 
-    # get data from regObs api. It returns 100 items at a time. If more, continue requesting with an offset. Paging.
-    while more_available:
+def _search_url():
+    """The url of the webapi search. All queries are posted here."""
+
+    return 'https://api.nve.no/hydrology/regobs/webapi_{0}/Search/All'.format(env.web_api_version)
+    # return 'http://tst-h-web03.nve.no/regobswebapi/Search/Rss?geoHazard=0'
+    # return 'https://api.nve.no/hydrology/demo/regobs/webapi_v3.2/Search/Rss?geoHazard=0'
 
-        # try or if there is an exception, try again.
+
+def _page_offsets(first_page):
+    """The webapi returns 100 items at a time. Given the first page of a query, returns the offsets of the rest.
+
+    :param first_page:  [dict] Responds from the webapi on offset 0.
+    :return:            [range]
+    """
+
+    return range(len(first_page['Results']), first_page['TotalMatches'], 100)
+
+
+def _iter_pages(rssquery, recursive_count=5, max_workers=env.web_api_max_workers):
+    """Generator of the pages responded by the webapi on one query. A page is the responds dictionary with
+    'TotalMatches' and up to 100 'Results'.
+
+    The first page is requested alone to learn the total number of matches. The remaining pages are requested in
+    parallel by a pool of max_workers threads and yielded in offset order. No more than max_workers pages are
+    requested ahead of the page the caller is at, so a slow caller does not fill up memory. A page that fails is
+    tried again up to recursive_count times. If it still fails, ConnectionError is raised where the page would have
+    been yielded, so the data is never taken to be complete when a page is missing. If the caller stops iterating,
+    pages not yet requested are cancelled. Pages are read from the response cache when a fresh copy is found.
+
+    :param rssquery:        [dict] As made by _make_rssquery.
+    :param recursive_count: [int] Attempt the same page # times before giving up on it.
+    :param max_workers:     [int] Pages requested at the same time.
+    :return:                [generator of dict]
+    """
+
+    url = _search_url()
+    max_age = mr.cache_max_age('webapi', rssquery['ToDate'])
+    attempts_pr_page = {}  # offset: number of attempts used
+
+    def _request_page(offset):
+        # Each page gets its own copy of the query so the threads dont share the offset.
+        def _post():
+            return mr.post_json(url, dict(rssquery, Offset=offset), max_age=max_age,
+                                required_keys=['Results', 'TotalMatches'])
+
+        # If a page fails only that offset is tried again. Pages already received are kept.
+        responds, attempts = mr.request_with_retry(
+            _post, description='_iter_pages offset {0}'.format(offset), max_attempts=recursive_count)
+        attempts_pr_page[offset] = attempts
+
+        # Names repeat on most registrations. Interned they are shared by all.
+        if responds is not None:
+            mr.intern_names(responds)
+
+        return responds
+
+    # get data from regObs api. It returns 100 items at a time. If more, request the rest with offsets. Paging.
+    responds = _request_page(0)
+
+    if responds is None:
+        ml.log_and_print("[error] getobservations.py -> _iter_pages: first page failed {0} times. Giving up."
+                         .format(recursive_count))
+        raise ConnectionError('First page of the webapi query failed {0} times'.format(recursive_count))
+
+    total_matches = responds['TotalMatches']
+    number_received = len(responds['Results'])
+
+    if total_matches == 0:
+        ml.log_and_print("[info] getobservations.py -> _iter_pages: no data")
+
+    yield responds
+
+    # The first page tells how many there are. The rest of the offsets are requested in parallel within a window
+    # of max_workers pages ahead of the one yielded.
+    offsets = iter(_page_offsets(responds))
+    with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+        window = deque((o, executor.submit(_request_page, o)) for o in islice(offsets, max(1, max_workers)))
         try:
-            r = requests.post(url, json=rssquery)
-            responds = r.json()
-            data += responds['Results']
+            while window:
+                offset, future = window.popleft()
+                page = future.result()
+
+                next_offset = next(offsets, None)
+                if next_offset is not None:
+                    window.append((next_offset, executor.submit(_request_page, next_offset)))
+
+                if page is None:
+                    ml.log_and_print("[error] getobservations.py -> _iter_pages: gave up on offset {0} after {1} "
+                                     "attempts".format(offset, recursive_count))
+                    raise ConnectionError('Page on offset {0} of the webapi query failed {1} times'
+                                          .format(offset, recursive_count))
+
+                number_received += len(page['Results'])
+                yield page
+        finally:
+            for _, future in window:
+                future.cancel()
+
+    if total_matches > 0:
+        ml.log_and_print("[info] getobservations.py -> _iter_pages: {0:.2f}%".format(
+            number_received / total_matches * 100))
+
+    # Report pages that needed more than one attempt
+    retried_pages = {o: a for o, a in sorted(attempts_pr_page.items()) if a > 1}
+    if retried_pages:
+        ml.log_and_print("[info] getobservations.py -> _iter_pages: attempts pr retried page (offset: attempts) {0}"
+                         .format(retried_pages))
+
+
+def _make_date_shards(from_date, to_date, shard_by='month'):
+    """Splits the period from from_date to to_date in shards of one calendar week (monday to sunday) or one calendar
+    month. The first and last shard are cut at from_date and to_date.
+
+    :param from_date:   [string or date] 'yyyy-mm-dd'. Included in the first shard.
+    :param to_date:     [string or date] 'yyyy-mm-dd'. Included in the last shard.
+    :param shard_by:    [string] 'week' or 'month'
+
+    :return:            [list of tuples] (from_date, to_date) pr shard. Both dates are included in the shard and the
+                        shards do not overlap. If a date is missing the period can not be split and is returned as is.
+    """
 
-            if output == 'Count nest':
-                ml.log_and_print("[info] getobservations.py -> _make_one_request: total matches {0}".format(
-                    responds['TotalMatches']))
-                return [responds['TotalMatches']]
+    def _to_date(date):
+        if isinstance(date, dt.datetime):
+            return date.date()
+        elif isinstance(date, dt.date):
+            return date
+        else:
+            return dt.datetime.strptime(date[0:10], '%Y-%m-%d').date()
+
+    if from_date is None or to_date is None:
+        return [(from_date, to_date)]
+
+    from_date = _to_date(from_date)
+    to_date = _to_date(to_date)
+
+    shards = []
+    shard_from = from_date
+    while shard_from <= to_date:
+        if shard_by == 'week':
+            shard_to = shard_from + dt.timedelta(days=6 - shard_from.weekday())
+        elif shard_by == 'month':
+            first_in_next_month = (shard_from.replace(day=1) + dt.timedelta(days=32)).replace(day=1)
+            shard_to = first_in_next_month - dt.timedelta(days=1)
+        else:
+            ml.log_and_print("[warning] getobservations.py -> _make_date_shards: Unsupported shard_by {0}. Not splitting."
+                             .format(shard_by))
+            return [(from_date, to_date)]
 
-            # log request status
-            if r.status_code <= 299:
+        shard_to = min(shard_to, to_date)
+        shards.append((shard_from, shard_to))
+        shard_from = shard_to + dt.timedelta(days=1)
 
-                if responds['TotalMatches'] == 0:
-                    ml.log_and_print("[info] getobservations.py -> _make_one_request: no data")
-                else:
-                    ml.log_and_print("[info] getobservations.py -> _make_one_request: {0:.2f}%".format(
-                        len(data) / responds['TotalMatches'] * 100))
+    return shards
 
-                # if more get more by adding to the offset
-                if len(data) < responds['TotalMatches']:
-                    rssquery['Offset'] += 100
-                else:
-                    more_available = False
 
-            else:
-                ml.log_and_print(
-                    "[error] getobservations.py -> _make_one_request: http {0} {1}".format(r.status_code, r.reason))
+def _make_one_request(rssquery, output='List', recursive_count=5, max_workers=env.web_api_max_workers):
+    """Part of get_data method. Collects all the pages of one query in offset order. Raises ConnectionError if a
+    page fails recursive_count times.
 
-        except Exception:
-            error_msg = sys.exc_info()[0]
-            ml.log_and_print(
-                "[error] getobservations.py -> _make_one_request: EXCEPTION. RECURSIVE COUNT {0} {1}".format(
-                    recursive_count, error_msg))
-
-            # When exception occurred, start requesting again. All that has happened in this scope is not important.
-            # Call this method again and make sure the received data goes direct to return at the bottom.
-
-            if recursive_count > 1:
-                recursive_count -= 1  # count down
-                data = _make_one_request(from_date=from_date,
-                                         to_date=to_date,
-                                         reg_id=reg_id,
-                                         registration_types=registration_types,
-                                         region_ids=region_ids,
-                                         location_id=location_id,
-                                         observer_id=observer_id,
-                                         observer_nick=observer_nick,
-                                         observer_competence=observer_competence,
-                                         group_id=group_id,
-                                         output=output,
-                                         geohazard_tids=geohazard_tids,
-                                         lang_key=lang_key,
-                                         recursive_count=recursive_count)
+    :param rssquery:        [dict] As made by _make_rssquery.
+    :param output:          [string] As in get_data. On 'Count nest' only the first page is requested.
+    :param recursive_count: [int] Attempt the same page # times before giving up on it.
+    :param max_workers:     [int] Pages requested at the same time.
+    :return:                [list] Registrations in the 'Nest' structure, or a list with the total number of matches.
+    """
 
-            more_available = False
+    data = []  # data from one query
+    pages = _iter_pages(rssquery, recursive_count=recursive_count, max_workers=max_workers)
+
+    for responds in pages:
+        if output == 'Count nest':
+            pages.close()
+            ml.log_and_print("[info] getobservations.py -> _make_one_request: total matches {0}".format(
+                responds['TotalMatches']))
+            return [responds['TotalMatches']]
+
+        data += responds['Results']
 
     return data
 
 
-def get_data(from_date=None, to_date=None, registration_types=None, reg_ids=None, region_ids=None, location_id=None,
-             observer_ids=None, observer_nick=None, observer_competence=None, group_id=None,
-             output='List', geohazard_tids=None, lang_key=1):
-    """Gets data from regObs webapi. Each observation returned as a dictionary in a list.
+def _make_rssqueries(from_date=None, to_date=None, registration_types=None, reg_ids=None, region_ids=None,
+                     location_id=None, observer_ids=None, observer_nick=None, observer_competence=None,
+                     group_id=None, geohazard_tids=None, lang_key=1, shard_by=None, changed_since=None):
+    """Makes the queries needed for a get_data request. Parameters the same as get_data.
 
-    :param from_date:           [string] 'yyyy-mm-dd'. Result includes from date.
-    :param to_date:             [string] 'yyyy-mm-dd'. Result includes to date.
-    :param registration_types:  [string or list of strings] Default None gives all.
-    :param reg_ids:             [int or list of ints] Default None gives all.
-    :param region_ids:          [int or list of ints]
-    :param location_id:         [int]
-    :param observer_ids:        [int or list of ints] Default None gives all.
-    :param observer_nick        [string] Part of a observer nick name
-    :param observer_competence  [int or list of int] as given in CompetenceLevelKDV
-    :param group_id:            [int]
-    :param output:              [string] 'Nest' collects all observations in one regid in one entry (defult for webapi).
-                                         'List' is a flatt structure with one entry pr observation type.
-                                         'Count nest' makes one request and picks out info on total matches
-                                         'Count list' counts every from in every observation.
-    :param geohazard_tids:      [int or list of ints] Default None gives all.
-    :param lang_key:            [int] Default 1 gives Norwegian.
+    The webapi takes one RegID and one ObserverID pr query, so there is one query pr combination and pr date shard.
 
-    :return:                    [list or int] Depending on output requested.
+    :return:    [list of dict] rssqueries
     """
 
     # If input isn't a list, make it so
@@ -309,27 +461,52 @@ def get_data(from_date=None, to_date=None, registration_types=None, reg_ids=None
     if not isinstance(reg_ids, list):
         reg_ids = [reg_ids]
 
-    # if output requested is 'Count' a number is expected, else a list og observations
-    all_data = []
+    if shard_by:
+        shards = _make_date_shards(from_date, to_date, shard_by=shard_by)
+    else:
+        shards = [(from_date, to_date)]
 
+    rssqueries = []
     for reg_id in reg_ids:
         for observer_id in observer_ids:
-            data = _make_one_request(
-                from_date=from_date, to_date=to_date, lang_key=lang_key, reg_id=reg_id,
-                registration_types=registration_types, region_ids=region_ids, geohazard_tids=geohazard_tids,
-                observer_id=observer_id, observer_nick=observer_nick, observer_competence=observer_competence,
-                group_id=group_id, location_id=location_id, output=output)
+            for shard_from_date, shard_to_date in shards:
+                rssqueries.append(_make_rssquery(
+                    from_date=shard_from_date, to_date=shard_to_date, reg_id=reg_id,
+                    registration_types=registration_types, region_ids=region_ids, location_id=location_id,
+                    observer_id=observer_id, observer_nick=observer_nick, observer_competence=observer_competence,
+                    group_id=group_id, geohazard_tids=geohazard_tids, lang_key=lang_key,
+                    changed_since=changed_since))
+
+    return rssqueries
+
 
-            all_data += data
+def _make_output(queried_data, output='List', method_name='get_data'):
+    """Part of get_data method. Puts together the data from all the queries to the output requested.
+
+    :param queried_data:    [list of lists] One list pr query as returned from _make_one_request.
+    :param output:          [string] As in get_data.
+    :param method_name:     [string] Method the output is made for. Used in the log.
+    :return:                [list or int] Depending on output requested.
+    """
 
     # Output 'Nest' is the structure returned from webapi. All observations on the same reg_id are grouped to one list item.
     # Output 'List' all observation elements are made a separate item on list.
     # Sums of each are available as 'Count list. and 'Count nest'.
     if output == 'Count nest':
-        return sum(all_data)
+        return sum(sum(data) for data in queried_data)
+
+    # data sorted with ascending observation time. Each query is sorted by itself and then merged with the others,
+    # which is cheaper than sorting all in one go.
+    def _obs_time(d):
+        return d['DtObsTime']
+
+    all_data = []
+    reg_ids_added = set()
+    for d in heapq.merge(*[sorted(data, key=_obs_time) for data in queried_data], key=_obs_time):
+        if d['RegId'] not in reg_ids_added:
+            reg_ids_added.add(d['RegId'])
+            all_data.append(d)
 
-    # data sorted with ascending observation time
-    all_data = sorted(all_data, key=lambda d: d['DtObsTime'])
     if output == 'Nest':
         return all_data
 
@@ -337,11 +514,7 @@ def get_data(from_date=None, to_date=None, registration_types=None, reg_ids=None
         listed_data = []
 
         for d in all_data:
-            for o in d['Registrations']:
-                listed_data.append({**d, **o})
-            for p in d['Pictures']:
-                p['RegistrationName'] = 'Bilde'
-                listed_data.append({**d, **p})
+            listed_data += _make_list(d)
 
         if output == 'List':
             return listed_data
@@ -349,14 +522,112 @@ def get_data(from_date=None, to_date=None, registration_types=None, reg_ids=None
             return len(listed_data)
 
     else:
-        ml.log_and_print('[warning] getobservations.py -> get_data: Unsupported output type.')
+        ml.log_and_print('[warning] getobservations.py -> {0}: Unsupported output type.'.format(method_name))
         return None
 
 
+def _make_list(d):
+    """Generator of the 'List' entries of one registration as returned from the webapi. There is one entry pr
+    observation form and one pr picture, each merged with the registration, location and observer info.
+
+    :param d:   [dict] One registration in the 'Nest' structure.
+    :return:    [generator of dict]
+    """
+
+    for o in d['Registrations']:
+        yield {**d, **o}
+    for p in d['Pictures']:
+        p['RegistrationName'] = 'Bilde'
+        yield {**d, **p}
+
+
+def _iter_forms(d, registration_tid=None):
+    """Generator of the forms and pictures of one registration of a given RegistrationTid. Same entries as
+    _make_list, but forms of other types are skipped before they are merged with the registration.
+
+    :param d:                   [dict] One registration in the 'Nest' structure.
+    :param registration_tid:    [int] Default None gives all forms and pictures.
+    :return:                    [generator of dict]
+    """
+
+    for o in d['Registrations']:
+        if registration_tid is None or _merged_value(o, d, 'RegistrationTid') == registration_tid:
+            yield {**d, **o}
+    for p in d['Pictures']:
+        if registration_tid is None or _merged_value(p, d, 'RegistrationTid') == registration_tid:
+            p['RegistrationName'] = 'Bilde'
+            yield {**d, **p}
+
+
+def _merged_value(form, registration, key):
+    """The value of key in {**registration, **form} without merging the two."""
+
+    if key in form:
+        return form[key]
+    return registration.get(key)
+
+
+def get_data(from_date=None, to_date=None, registration_types=None, reg_ids=None, region_ids=None, location_id=None,
+             observer_ids=None, observer_nick=None, observer_competence=None, group_id=None,
+             output='List', geohazard_tids=None, lang_key=1, shard_by=None, max_workers=env.web_api_max_workers,
+             changed_since=None):
+    """Gets data from regObs webapi. Each observation returned as a dictionary in a list.
+
+    The webapi takes one RegID and one ObserverID pr query. If lists are given, one query is made pr combination
+    (and pr shard) and they are requested in parallel. A registration matching more than one query is returned once.
+
+    :param from_date:           [string] 'yyyy-mm-dd'. Result includes from date.
+    :param to_date:             [string] 'yyyy-mm-dd'. Result includes to date.
+    :param registration_types:  [string or list of strings] Default None gives all.
+    :param reg_ids:             [int or list of ints] Default None gives all.
+    :param region_ids:          [int or list of ints]
+    :param location_id:         [int]
+    :param observer_ids:        [int or list of ints] Default None gives all.
+    :param observer_nick        [string] Part of a observer nick name
+    :param observer_competence  [int or list of int] as given in CompetenceLevelKDV
+    :param group_id:            [int]
+    :param output:              [string] 'Nest' collects all observations in one regid in one entry (defult for webapi).
+                                         'List' is a flatt structure with one entry pr observation type.
+                                         'Count nest' makes one request and picks out info on total matches
+                                         'Count list' counts every from in every observation.
+    :param geohazard_tids:      [int or list of ints] Default None gives all.
+    :param lang_key:            [int] Default 1 gives Norwegian.
+    :param shard_by:            [string] None makes one query of the whole period. 'week' or 'month' splits the
+                                period in shards which are requested in parallel. Speeds up long periods.
+    :param max_workers:         [int] Max number of requests to the webapi at the same time.
+    :param changed_since:       [datetime or string] Only registrations made or changed after this time. Default
+                                None gives all.
+
+    :return:                    [list or int] Depending on output requested. Note, 'Count nest' is the sum of
+                                matches pr query and counts a registration matching more than one query each time.
+
+    Raises ConnectionError if a page of the webapi fails on all attempts. Partial data is not returned.
+    """
+
+    rssqueries = _make_rssqueries(
+        from_date=from_date, to_date=to_date, registration_types=registration_types, reg_ids=reg_ids,
+        region_ids=region_ids, location_id=location_id, observer_ids=observer_ids, observer_nick=observer_nick,
+        observer_competence=observer_competence, group_id=group_id, geohazard_tids=geohazard_tids, lang_key=lang_key,
+        shard_by=shard_by, changed_since=changed_since)
+
+    # All queries are requested in parallel, and each query pages in parallel. The workers are shared between the
+    # two so the number of requests at the same time stays within max_workers.
+    query_workers = max(1, min(max_workers, len(rssqueries)))
+    page_workers = max(1, max_workers // query_workers)
+    request_query = partial(_make_one_request, output=output, max_workers=page_workers)
+
+    # if output requested is 'Count' a number is expected, else a list og observations. One list pr query.
+    with ThreadPoolExecutor(max_workers=query_workers) as executor:
+        queried_data = list(executor.map(request_query, rssqueries))
+
+    return _make_output(queried_data, output=output)
+
+
 def get_data_as_class(from_date=None, to_date=None, registration_types=None, reg_ids=None, region_ids=None,
                       location_id=None,
                       observer_ids=None, observer_nick=None, observer_competence=None, group_id=None,
-                      output='Nest', geohazard_tids=None, lang_key=1):
+                      output='Nest', geohazard_tids=None, lang_key=1, shard_by=None,
+                      max_workers=env.web_api_max_workers, compact=False, changed_since=None):
     """Uses the get_data method and maps all data to their respective class. Returns data as list or nest.
 
     :param from_date:           [string] 'yyyy-mm-dd'. Result includes from date.
@@ -373,6 +644,11 @@ def get_data_as_class(from_date=None, to_date=None, registration_types=None, reg
                                          'List' is a flatt structure with one entry pr observation type.
     :param geohazard_tids:      [int or list of ints] Default None gives all.
     :param lang_key:            [int] Default 1 gives Norwegian.
+    :param shard_by:            [string] None, 'week' or 'month'. See get_data.
+    :param max_workers:         [int] Max number of requests to the webapi at the same time.
+    :param compact:             [bool] If True, observations are returned as CompactObservation without the raw
+                                data from the api. Uses much less memory.
+    :param changed_since:       [datetime or string] Only registrations made or changed after this time.
 
     :return:                    [list or int] Depending on output requested.
     """
@@ -380,16 +656,95 @@ def get_data_as_class(from_date=None, to_date=None, registration_types=None, reg
     data = get_data(from_date=from_date, to_date=to_date, registration_types=registration_types, reg_ids=reg_ids,
                     region_ids=region_ids, location_id=location_id, observer_ids=observer_ids,
                     observer_nick=observer_nick, observer_competence=observer_competence, group_id=group_id,
-                    output=output, geohazard_tids=geohazard_tids, lang_key=lang_key)
+                    output=output, geohazard_tids=geohazard_tids, lang_key=lang_key, shard_by=shard_by,
+                    max_workers=max_workers, changed_since=changed_since)
 
     data_in_classes = []
 
     for d in data:
-        data_in_classes.append(Observation(d))
+        if compact:
+            data_in_classes.append(compact_observation(Observation(d)))
+        else:
+            data_in_classes.append(Observation(d))
 
     return data_in_classes
 
 
+def iter_data(from_date=None, to_date=None, registration_types=None, reg_ids=None, region_ids=None, location_id=None,
+              observer_ids=None, observer_nick=None, observer_competence=None, group_id=None,
+              output='List', geohazard_tids=None, lang_key=1):
+    """Same as get_data, but a generator. Registrations are yielded page by page as they arrive from the webapi,
+    so the first ones can be used while the rest are requested and a whole season never has to be held in memory.
+
+    Registrations come in the order the webapi pages them and are not sorted on DtObsTime as in get_data. If a
+    page fails on all attempts, ConnectionError is raised when the generator gets there.
+
+    :param from_date:           [string] 'yyyy-mm-dd'. Result includes from date.
+    :param to_date:             [string] 'yyyy-mm-dd'. Result includes to date.
+    :param registration_types:  [string or list of strings] Default None gives all.
+    :param reg_ids:             [int or list of ints] Default None gives all.
+    :param region_ids:          [int or list of ints]
+    :param location_id:         [int]
+    :param observer_ids:        [int or list of ints] Default None gives all.
+    :param observer_nick        [string] Part of a observer nick name
+    :param observer_competence  [int or list of int] as given in CompetenceLevelKDV
+    :param group_id:            [int]
+    :param output:              [string] 'Nest' yields one entry pr regid as returned from the webapi.
+                                         'List' yields one entry pr observation type.
+    :param geohazard_tids:      [int or list of ints] Default None gives all.
+    :param lang_key:            [int] Default 1 gives Norwegian.
+
+    :return:                    [generator of dict]
+
+    Ex of use:  for o in iter_data(from_date='2018-12-01', to_date='2019-05-31', output='Nest'):
+                    ...
+    """
+
+    if output not in ['Nest', 'List']:
+        ml.log_and_print('[warning] getobservations.py -> iter_data: Unsupported output type.')
+        return
+
+    rssqueries = _make_rssqueries(
+        from_date=from_date, to_date=to_date, registration_types=registration_types, reg_ids=reg_ids,
+        region_ids=region_ids, location_id=location_id, observer_ids=observer_ids, observer_nick=observer_nick,
+        observer_competence=observer_competence, group_id=group_id, geohazard_tids=geohazard_tids, lang_key=lang_key)
+
+    for rssquery in rssqueries:
+        for responds in _iter_pages(rssquery):
+            for d in responds['Results']:
+                if output == 'Nest':
+                    yield d
+                else:
+                    yield from _make_list(d)
+
+
+def iter_data_as_class(from_date=None, to_date=None, registration_types=None, reg_ids=None, region_ids=None,
+                       location_id=None, observer_ids=None, observer_nick=None, observer_competence=None,
+                       group_id=None, output='Nest', geohazard_tids=None, lang_key=1):
+    """Uses the iter_data method and maps the data to their respective class as they arrive. Parameters the same
+    as iter_data.
+
+    :param output:              [string] 'Nest' yields one Observation pr regid.
+                                         'List' yields the observation forms and pictures of each regid as their
+                                         own classes, e.g. DangerSign or PictureObservation.
+
+    :return:                    [generator of class objects]
+    """
+
+    data = iter_data(from_date=from_date, to_date=to_date, registration_types=registration_types, reg_ids=reg_ids,
+                     region_ids=region_ids, location_id=location_id, observer_ids=observer_ids,
+                     observer_nick=observer_nick, observer_competence=observer_competence, group_id=group_id,
+                     output='Nest', geohazard_tids=geohazard_tids, lang_key=lang_key)
+
+    for d in data:
+        observation = Observation(d)
+        if output == 'Nest':
+            yield observation
+        else:
+            yield from observation.Observations
+            yield from observation.Pictures
+
+
 class Registration:
 
     def __init__(self, d):
@@ -479,60 +834,15 @@ class Observation(Registration, Location, Observer):
         Location.__init__(self, d)
         Observer.__init__(self, d)
 
+        # The class pr RegistrationTID is found in _registration_classes.
         self.Observations = []
         for r in d['Registrations']:
-            if r['RegistrationTid'] == 10:
-                observation = GeneralObservation({**d, **r})
-            elif r['RegistrationTid'] == 11:
-                observation = Incident({**d, **r})
-            elif r['RegistrationTid'] == 12:
-                observation = PictureObservation({**d, **r})
-            elif r['RegistrationTid'] == 13:
-                observation = DangerSign({**d, **r})
-            elif r['RegistrationTid'] == 14:
-                observation = DamageObs({**d, **r})
-            elif r['RegistrationTid'] == 21:
-                observation = WeatherObservation({**d, **r})
-            elif r['RegistrationTid'] == 22:
-                observation = SnowSurfaceObservation({**d, **r})
-            # Snow profile has a new form and TID pr dec 2018
-            elif r['RegistrationTid'] == 23:
-                observation = SnowProfilePicture({**d, **r})
-            elif r['RegistrationTid'] == 25:
-                observation = ColumnTest({**d, **r})
-            elif r['RegistrationTid'] == 26:
-                observation = AvalancheObs({**d, **r})
-            elif r['RegistrationTid'] == 27:
-                observation = AvalancheActivityObs({**d, **r})
-            elif r['RegistrationTid'] == 28:
-                observation = AvalancheEvaluation({**d, **r})
-            elif r['RegistrationTid'] == 30:
-                observation = AvalancheEvaluation2({**d, **r})
-            elif r['RegistrationTid'] == 31:
-                observation = AvalancheEvaluation3({**d, **r})
-            elif r['RegistrationTid'] == 32:
-                observation = AvalancheEvalProblem2({**d, **r})
-            elif r['RegistrationTid'] == 33:
-                observation = AvalancheActivityObs2({**d, **r})
-            elif r['RegistrationTid'] == 36:
-                observation = SnowProfile({**d, **r})
-            elif r['RegistrationTid'] == 50:
-                observation = IceThickness({**d, **r})
-            elif r['RegistrationTid'] == 51:
-                observation = IceCover({**d, **r})
-            elif r['RegistrationTid'] == 61:
-                observation = WaterLevel({**d, **r})
-            elif r['RegistrationTid'] == 62:
-                observation = WaterLevel2({**d, **r})
-            elif r['RegistrationTid'] == 71:
-                observation = LandSlideObs({**d, **r})
+            registration_class = _registration_classes.get(r['RegistrationTid'])
+            if registration_class:
+                self.Observations.append(registration_class({**d, **r}))
             else:
-                observation = None
                 ml.log_and_print("[warning] Unrecognized RegistrationTID given {0}".format(r['RegistrationTid']))
 
-            if observation:
-                self.Observations.append(observation)
-
         self.Pictures = []
         for p in d['Pictures']:
             self.Pictures.append(PictureObservation({**d, **p}))
@@ -1379,6 +1689,168 @@ class LandSlideObs(Registration, Location, Observer, Pictures):
         self.LangKey = d['LangKey']
 
 
+# The class of each registration form pr RegistrationTID. Used when mapping a registration to Observation.
+_registration_classes = {
+    10: GeneralObservation,
+    11: Incident,
+    12: PictureObservation,
+    13: DangerSign,
+    14: DamageObs,
+    21: WeatherObservation,
+    22: SnowSurfaceObservation,
+    23: SnowProfilePicture,         # Snow profile has a new form and TID pr dec 2018
+    25: ColumnTest,
+    26: AvalancheObs,
+    27: AvalancheActivityObs,
+    28: AvalancheEvaluation,
+    30: AvalancheEvaluation2,
+    31: AvalancheEvaluation3,
+    32: AvalancheEvalProblem2,
+    33: AvalancheActivityObs2,
+    36: SnowProfile,
+    50: IceThickness,
+    51: IceCover,
+    61: WaterLevel,
+    62: WaterLevel2,
+    71: LandSlideObs}
+
+
+class _Shape:
+    """The class and attribute names shared by all CompactObservations made from objects of the same class with
+    the same attributes. Shapes are interned in _shapes, also when unpickled, so a season holds one of each."""
+
+    __slots__ = ('cls', 'fields', 'index')
+
+    def __init__(self, cls, fields):
+        self.cls = cls
+        self.fields = fields
+        self.index = {field: i for i, field in enumerate(fields)}
+
+    def __reduce__(self):
+        return _get_shape, (self.cls, self.fields)
+
+
+_shapes = {}
+
+
+def _get_shape(cls, fields):
+    """Returns the shared _Shape of the class and attribute names. Made on first use."""
+
+    key = (cls, fields)
+    shape = _shapes.get(key)
+    if shape is None:
+        shape = _shapes.setdefault(key, _Shape(cls, fields))
+
+    return shape
+
+
+def _make_compact_observation(shape, values):
+    """Used when unpickling a CompactObservation."""
+
+    return CompactObservation(shape, values)
+
+
+class CompactObservation:
+    """Compact version of an observation or form (or any other of the classes in this module). Attribute values
+    are kept in a list and the attribute names in a shape shared with all others of the same class, so there is no
+    __dict__ pr object. Make them with compact_observation.
+
+    Attributes are read and set as on the original object, and methods of the original class are available.
+    o.__class__ is the original class, so isinstance(o, DangerSign) and o.__class__.__name__ work as before.
+    type(o) is still CompactObservation, so lookups keyed on the class of an observation must use o.__class__."""
+
+    __slots__ = ('_shape', '_values')
+
+    def __init__(self, shape, values):
+        object.__setattr__(self, '_shape', shape)
+        object.__setattr__(self, '_values', list(values))
+
+    @property
+    def __class__(self):
+        return self._shape.cls
+
+    def __getattr__(self, name):
+        # Only called when name is not a slot or on this class.
+        if name in CompactObservation.__slots__:
+            raise AttributeError(name)
+
+        shape = self._shape
+        i = shape.index.get(name)
+        if i is not None:
+            return self._values[i]
+
+        # Methods of the original class, eg. to_dict on Incident, are bound to this object.
+        method = getattr(shape.cls, name, None)
+        if callable(method):
+            return method.__get__(self)
+
+        raise AttributeError("'{0}' has no attribute '{1}'".format(shape.cls.__name__, name))
+
+    def __setattr__(self, name, value):
+        shape = self._shape
+        i = shape.index.get(name)
+        if i is not None:
+            self._values[i] = value
+        else:
+            object.__setattr__(self, '_shape', _get_shape(shape.cls, shape.fields + (name,)))
+            self._values.append(value)
+
+    def __reduce__(self):
+        return _make_compact_observation, (self._shape, tuple(self._values))
+
+    def __dir__(self):
+        return list(self._shape.fields)
+
+    def __repr__(self):
+        return 'Compact{0}({1})'.format(self._shape.cls.__name__, ', '.join(
+            '{0}={1!r}'.format(f, v) for f, v in zip(self._shape.fields, self._values)))
+
+    def _asdict(self):
+        """The attributes as a dict, as vars() on the original object."""
+        return dict(zip(self._shape.fields, self._values))
+
+
+_raw_fields = ('FullObject', 'OriginalData')
+
+# Classes made compact when found on an observation, eg. the forms in Observation.Observations, the layers of a
+# snow profile or the problems of an avalanche evaluation.
+_compactable_classes = tuple(_registration_classes.values()) + (
+    Observation, AllRegistrations, AvalancheEvalProblem0, AvalancheEvalProblem, StratProfileLayer, SnowTempLayer,
+    SnowDensity, SnowDensityLayer, ProfileColumnTest, IceThicknessLayer, WaterLevelMeasurement)
+
+
+def _compact_value(value, keep_raw):
+    """Part of compact_observation. Makes objects of the _compactable_classes compact, also when in lists, eg. the
+    forms in Observation.Observations or the layers in a snow profile."""
+
+    if isinstance(value, list):
+        return [_compact_value(v, keep_raw) for v in value]
+
+    if isinstance(value, _compactable_classes):
+        return compact_observation(value, keep_raw=keep_raw)
+
+    return value
+
+
+def compact_observation(observation, keep_raw=False):
+    """Makes a compact copy of an observation, form or picture. See CompactObservation. Forms, pictures and layers
+    on the observation are made compact as well.
+
+    :param observation: [object] Any of the classes in this module.
+    :param keep_raw:    [bool] If False, the raw data from the api (FullObject and OriginalData) is not kept.
+    :return:            [CompactObservation]
+    """
+
+    if type(observation) is CompactObservation:
+        return observation
+
+    attributes = vars(observation)
+    fields = tuple(f for f in attributes if keep_raw or f not in _raw_fields)
+    values = [_compact_value(attributes[f], keep_raw) for f in fields]
+
+    return CompactObservation(_get_shape(type(observation), fields), values)
+
+
 def _get_general(registration_class_type, registration_types, from_date, to_date, region_ids=None, location_id=None,
                  observer_ids=None, observer_nick=None, observer_competence=None, group_id=None,
                  output='List', geohazard_tids=None, lang_key=1):
@@ -1397,7 +1869,8 @@ def _get_general(registration_class_type, registration_types, from_date, to_date
     :param geohazard_tids       [int or list of ints] 10 is snow, 20,30,40 are dirt, 60 is water and 70 is ice
     :param lang_key             [int] 1 is norwegian, 2 is english
 
-    :return:
+    :return:                    [list, DataFrame or int] Depending on output requested. 'Count' is the number of
+                                forms of the requested type.
     """
 
     list = None
@@ -1405,34 +1878,20 @@ def _get_general(registration_class_type, registration_types, from_date, to_date
         ml.log_and_print('getobservations.py -> _get_general: Illegal output option.')
         return list
 
-    # In these methods "Count" is obviously to count the list of forms, where as in the more general get_data
-    # counting a list and counting a nested list of full observations are two different things.
-    output_for_get_data = output
+    # The registrations are requested as they come from the webapi and the forms of the requested type are picked
+    # out before they are made to a class. Forms of other types in the same registrations are never merged or copied.
+    # Registrations come sorted on DtObsTime from get_data, and so do the forms picked out of them.
+    nested_data = get_data(from_date=from_date, to_date=to_date, region_ids=region_ids, observer_ids=observer_ids,
+                           observer_nick=observer_nick, observer_competence=observer_competence,
+                           group_id=group_id, location_id=location_id, lang_key=lang_key,
+                           output='Nest', registration_types=registration_types,
+                           geohazard_tids=geohazard_tids)
+
+    # registration_types is None is for all registrations and no single type is picked out.
     if output == 'Count':
-        output_for_get_data = 'Count list'
+        return sum(1 for d in nested_data for _ in _iter_forms(d, registration_types))
 
-    # Data frames are based on the lists
-    if output == 'DataFrame':
-        output_for_get_data = 'List'
-
-    data_with_more = get_data(from_date=from_date, to_date=to_date, region_ids=region_ids, observer_ids=observer_ids,
-                              observer_nick=observer_nick, observer_competence=observer_competence,
-                              group_id=group_id, location_id=location_id, lang_key=lang_key,
-                              output=output_for_get_data, registration_types=registration_types,
-                              geohazard_tids=geohazard_tids)
-
-    # wash out all other observation types
-    data = []
-    if registration_types:
-        for d in data_with_more:
-            if d['RegistrationTid'] == registration_types:
-                data.append(d)
-    else:  # registration_types is None is for all registrations and no single type is picked out.
-        data = data_with_more
-
-    if output == 'List' or output == 'DataFrame':
-        list = [registration_class_type(d) for d in data]
-        list = sorted(list, key=lambda registration_class_type: registration_class_type.DtObsTime)
+    list = [registration_class_type(form) for d in nested_data for form in _iter_forms(d, registration_types)]
 
     if output == 'List':
         return list
@@ -1440,8 +1899,63 @@ def _get_general(registration_class_type, registration_types, from_date, to_date
     if output == 'DataFrame':
         return _make_data_frame(list)
 
-    if output == 'Count':
-        return data
+
+def get_observations_by_type(registration_types, from_date, to_date, region_ids=None, location_id=None,
+                             observer_ids=None, observer_nick=None, observer_competence=None, group_id=None,
+                             geohazard_tids=None, lang_key=1):
+    """Gets observations of several types in one query and maps each form to the class of its type, the same as the
+    get_<type> methods do. Calling the get_<type> methods one by one pages through the same registrations once pr
+    type. Here they are paged through once.
+
+    :param registration_types:  [list of ints] RegistrationTIDs for the requested observation types. The classes
+                                are given in _registration_classes.
+    :param from_date:           [date] A query returns [from_date, to_date]
+    :param to_date:             [date] A query returns [from_date, to_date]
+    :param region_ids:          [int or list of ints] If region_ids = None, all regions are selected
+    :param location_id:         [int] LocationID as given in the ObsLocation table in regObs.
+    :param observer_ids:        [int or list of ints] If observer_ids = None, all observers are selected
+    :param observer_nick:       [int or list of ints] Default None gives all.
+    :param observer_competence: [string] Part of a observer nick name
+    :param group_id:            [int] ObserverGroupID as given in the ObserverGroup table in regObs.
+    :param geohazard_tids       [int or list of ints] 10 is snow, 20,30,40 are dirt, 60 is water and 70 is ice
+    :param lang_key             [int] 1 is norwegian, 2 is english
+
+    :return:                    [dict] {RegistrationTID: [list of observations]} with a list for each type
+                                requested. The lists are sorted on DtObsTime.
+
+    Ex of use:  observations = get_observations_by_type([28, 30, 31], '2012-12-01', '2013-05-31', region_ids=3011)
+                evaluations_3 = observations[31]
+    """
+
+    # If input isn't a list, make it so
+    if not isinstance(registration_types, list):
+        registration_types = [registration_types]
+
+    observations = {}
+    for registration_type in registration_types:
+        if registration_type in _registration_classes:
+            observations[registration_type] = []
+        else:
+            ml.log_and_print("[warning] getobservations.py -> get_observations_by_type: RegistrationTID {0} not "
+                             "supported.".format(registration_type))
+
+    if not observations:
+        return observations
+
+    nested_data = get_data(from_date=from_date, to_date=to_date, region_ids=region_ids, observer_ids=observer_ids,
+                           observer_nick=observer_nick, observer_competence=observer_competence,
+                           group_id=group_id, location_id=location_id, lang_key=lang_key,
+                           output='Nest', registration_types=list(observations),
+                           geohazard_tids=geohazard_tids)
+
+    # Registrations come sorted on DtObsTime and so do the forms split out of them.
+    for d in nested_data:
+        for form in _iter_forms(d):
+            registration_type = form['RegistrationTid']
+            if registration_type in observations:
+                observations[registration_type].append(_registration_classes[registration_type](form))
+
+    return observations
 
 
 def get_land_slide_obs(from_date, to_date, region_ids=None, location_id=None, group_id=None,
@@ -2207,6 +2721,7 @@ if __name__ == "__main__":
     # one_observer_count_nest = get_data(from_date='2012-01-01', to_date='2018-01-01', observer_ids=6, output='Count nest')
     # ice_data = get_data(from_date='2016-10-01', to_date='2016-11-01', geohazard_tids=70, output='Nest')
 
+    # benchmark = _benchmark_observation(get_data('2018-01-01', '2018-02-01', output='Nest'))
     # data = _raw_play_ground()
     # _the_simplest_webapi_request()
 
@@ -1,5 +1,7 @@
 import datetime as dt
+from concurrent.futures import ThreadPoolExecutor
 from varsomdata import getobservations as go
+from varsomdata import getdangers as gd
 from varsomdata import getforecastapi as gfa
 from varsomdata import varsomclasses as vc
 from utilities import makelogs as ml
@@ -196,28 +198,36 @@ def get_all_problems(region_ids, from_date, to_date, add_danger_level=True, prob
     if not isinstance(region_ids, list):
         region_ids = [region_ids]
 
-    if problems_from == 'All':
-        evaluations_1 = go.get_avalanche_evaluation(region_ids=region_ids, from_date=from_date, to_date=to_date, lang_key=lang_key)
-        evaluations_2 = go.get_avalanche_evaluation_2(region_ids=region_ids, from_date=from_date, to_date=to_date, lang_key=lang_key)
-        eval_problems_2 = go.get_avalanche_problem_2(region_ids=region_ids, from_date=from_date, to_date=to_date, lang_key=lang_key)
-        warnings = gfa.get_avalanche_warnings(region_ids=region_ids, from_date=from_date, to_date=to_date, lang_key=lang_key)
-
-    elif problems_from == 'Forecast':
-        evaluations_1 = []
-        evaluations_2 = []
-        eval_problems_2 = []
-        warnings = gfa.get_avalanche_warnings(region_ids=region_ids, from_date=from_date, to_date=to_date, lang_key=lang_key)
-
-    elif problems_from == 'Observation':
-        evaluations_1 = go.get_avalanche_evaluation(region_ids=region_ids, from_date=from_date, to_date=to_date, lang_key=lang_key)
-        evaluations_2 = go.get_avalanche_evaluation_2(region_ids=region_ids, from_date=from_date, to_date=to_date, lang_key=lang_key)
-        eval_problems_2 = go.get_avalanche_problem_2(region_ids=region_ids, from_date=from_date, to_date=to_date, lang_key=lang_key)
-        warnings = []
-
-    else:
+    if problems_from not in ['All', 'Forecast', 'Observation']:
         ml.log_and_print('getproblems.py -> get_all_problems: Unknown request problems_from={0}'.format(problems_from))
         return 'Unknown request problems_from={0}'.format(problems_from)
 
+    # Warnings are needed for forecasted problems and for adding danger levels. They are requested from the forecast
+    # api at the same time as the observations are requested from regObs.
+    with ThreadPoolExecutor(max_workers=1) as executor:
+
+        if problems_from != 'Observation' or add_danger_level:
+            warnings_future = executor.submit(gfa.get_avalanche_warnings, region_ids=region_ids, from_date=from_date,
+                                              to_date=to_date, lang_key=lang_key)
+
+        if problems_from != 'Forecast':
+            # All forms with problems in one query. 28 is AvalancheEvaluation, 30 AvalancheEvaluation2 and
+            # 32 AvalancheEvalProblem2.
+            observations = go.get_observations_by_type([28, 30, 32], region_ids=region_ids, from_date=from_date,
+                                                       to_date=to_date, lang_key=lang_key)
+            evaluations_1 = observations[28]
+            evaluations_2 = observations[30]
+            eval_problems_2 = observations[32]
+        else:
+            evaluations_1 = []
+            evaluations_2 = []
+            eval_problems_2 = []
+
+        if problems_from != 'Observation':
+            warnings = warnings_future.result()
+        else:
+            warnings = []
+
     problem_0 = _map_eval1_to_problem(evaluations_1)
     problem_1 = _map_eval2_to_problem(evaluations_2)
     problem_2 = _map_eval_problem_2_to_problem(eval_problems_2)
@@ -231,22 +241,15 @@ def get_all_problems(region_ids, from_date, to_date, add_danger_level=True, prob
 
         # If only looking for observations, warnings with danger level not got.
         if problems_from == 'Observation':
-            warnings = gfa.get_avalanche_warnings(region_ids=region_ids, from_date=from_date, to_date=to_date, lang_key=lang_key)
+            warnings = warnings_future.result()
 
         all_non_zero_warnings = [w for w in warnings if w.danger_level != 0]
-        all_non_zero_warnings.sort(key=lambda AvalancheDanger: AvalancheDanger.date)
+        warnings_index = gd.index_dangers_by_date_and_region(all_non_zero_warnings)
 
-        # Lots of looping. Be smart. Keep track of last index since both lists are ordered by date. Break inner loop and go to next problem if forecasts are older than the problem.
-        last_i = 0
         for p in all_problems:
-            for i in range(last_i, len(all_non_zero_warnings), 1):
-
-                if all_non_zero_warnings[i].date > p.date:
-                    last_i = max(0, i-1-len(region_ids))
-                    break
-
-                elif p.date == all_non_zero_warnings[i].date and p.region_regobs_id == all_non_zero_warnings[i].region_regobs_id:
-                    p.set_danger_level(all_non_zero_warnings[i].danger_level_name, all_non_zero_warnings[i].danger_level)
+            w = warnings_index.get((p.date, p.region_regobs_id))
+            if w is not None:
+                p.set_danger_level(w.danger_level_name, w.danger_level)
 
     return all_problems
 
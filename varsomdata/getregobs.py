@@ -1,8 +1,8 @@
 # -*- coding: utf-8 -*-
 import datetime
-import requests
 from varsomdata import getforecastapi as fa
 from utilities import fencoding as fe
+from utilities import makerequests as mr
 import setenvironment as env
 from varsomdata import getkdvelements as gkdv
 from varsomdata import getdangers as gd
@@ -102,7 +102,7 @@ def get_problems_from_AvalancheProblemV(region_id, start_date, end_date):
     url = "http://api.nve.no/hydrology/regobs/{0}/Odata.svc/{1}?$filter={2}&$format=json".format(api_version, view, odata_query)
     #url = "http://api.nve.no/hydrology/regobs/{0}/Odata.svc/{1}?$filter={2}&$format=json".decode('utf8').format(odata_version, view, odata_query)
 
-    result = requests.get(url).json()
+    result = mr.get(url).json()
     result = result['d']['results']
 
     print('getregobs.py -> get_problems_from_AvalancheProblemV: {0} observations for {1} in from {2} to {3}.'\
@@ -175,7 +175,7 @@ def get_problems_from_AvalancheEvalProblemV(region_id, start_date, end_date):
     url = "http://api.nve.no/hydrology/regobs/{0}/Odata.svc/{1}?$filter={2}&$format=json".format(
         api_version, view, odata_query)
 
-    result = requests.get(url).json()
+    result = mr.get(url).json()
     result = result['d']['results']
 
     print('getregobs.py -> get_problems_from_AvalancheEvalProblemV: {0} observations for {1} in from {2} to {3}.'\
@@ -286,7 +286,7 @@ def get_problems_from_AvalancheEvalProblem2V(region_id, start_date, end_date):
     url = "http://api.nve.no/hydrology/regobs/{0}/Odata.svc/{1}?$filter={2}&$format=json".format(
         api_version, view, odata_query)
 
-    result = requests.get(url).json()
+    result = mr.get(url).json()
     result = result['d']['results']
 
     print('getregobs.py -> get_problems_from_AvalancheEvalProblem2V: {0} observations for {1} in from {2} to {3}.'\
@@ -412,7 +412,7 @@ def get_problems_from_AvalancheWarningV(region_id, start_date, end_date):
 
     url = "http://api.nve.no/hydrology/regobs/{0}/Odata.svc/{1}?$filter={2}&$format=json".format(
         env.api_version, view, odata_query)
-    result = requests.get(url).json()
+    result = mr.get(url).json()
     try:
         result = result['d']['results']
     except:
@@ -557,7 +557,7 @@ def get_problems_from_AvalancheWarnProblemV(region_id, start_date, end_date):
 
     url = "http://api.nve.no/hydrology/regobs/{0}/Odata.svc/{1}?$filter={2}&$format=json".format(
         env.api_version, view, odata_query)
-    result = requests.get(url).json()
+    result = mr.get(url).json()
     try:
         result = result['d']['results']
     except:
@@ -651,7 +651,7 @@ def get_observed_danger_AvalancheEvaluation3V(region_id, start_date, end_date):
     #oDataQuery = fe.add_norwegian_letters(oDataQuery)    # Need norwegian letters in the URL
 
     url = "http://api.nve.no/hydrology/regobs/{0}/Odata.svc/AvalancheEvaluation3V?$filter={1}&$format=json".format(api_version, oDataQuery)
-    AvalancheEvaluation3V = requests.get(url).json()
+    AvalancheEvaluation3V = mr.get(url).json()
     avalEval3 = AvalancheEvaluation3V['d']['results']
 
     print('getregobs.py -> get_observed_danger_AvalancheEvaluation3V: {0} observations for {1} in from {2} to {3}.'\
@@ -705,7 +705,7 @@ def get_observed_danger_AvalancheEvaluation2V(region_id, start_date, end_date):
     #oDataQuery = fe.add_norwegian_letters(oDataQuery)    # Need norwegian letters in the URL
 
     url = "http://api.nve.no/hydrology/regobs/{0}/Odata.svc/AvalancheEvaluation2V?$filter={1}&$format=json".format(api_version, oDataQuery)
-    AvalancheEvaluation2V = requests.get(url).json()
+    AvalancheEvaluation2V = mr.get(url).json()
     avalEval2 = AvalancheEvaluation2V['d']['results']
 
     print('getregobs.py -> get_observed_danger_AvalancheEvaluation2V: {0} observations for {1} in from {2} to {3}.'\
@@ -755,7 +755,7 @@ def get_observed_danger_AvalancheEvaluationV(region_id, start_date, end_date):
     #oDataQuery = fe.add_norwegian_letters(oDataQuery)    # Need norwegian letters in the URL
 
     url = "http://api.nve.no/hydrology/regobs/{0}/Odata.svc/AvalancheEvaluationV?$filter={1}&$format=json".format(api_version, oDataQuery)
-    AvalancheEvaluationV = requests.get(url).json()
+    AvalancheEvaluationV = mr.get(url).json()
     avalEval = AvalancheEvaluationV['d']['results']
 
     print('getregobs.py -> get_observed_danger_AvalancheEvaluationV: {0} observations for {1} in from {2} to {3}.'\
@@ -8,12 +8,19 @@ from varsomdata import getobservations as go
 from varsomdata import getmisc as gm
 from utilities import makepickle as mp
 from utilities import makelogs as ml
+from utilities import makerefresh as mrf
 import datetime as dt
+import json as json
 import os as os
+import sys as sys
 
 __author__ = 'raek'
 
 
+_registration_tids = {registration_class: registration_tid
+                      for registration_tid, registration_class in go._registration_classes.items()}
+
+
 def _observation_is_not_empty(o):
     """Test if an observation form is empty. Might occur when making list of nests and only pictures are given.
     Method will need to expand if empty cases occur on other forms."""
@@ -25,96 +32,453 @@ def _observation_is_not_empty(o):
     return True
 
 
-def get_all_observations(year, output='Nest', geohazard_tids=None, lang_key=1, max_file_age=23):
+def _make_listed_observations(nested_observations):
+    """Lists all observation forms and pictures in the registrations. Empty forms are left out."""
+
+    listed_observations = []
+    for d in nested_observations:
+        for o in d.Observations:
+            if _observation_is_not_empty(o):
+                listed_observations.append(o)
+        for p in d.Pictures:
+            # p['RegistrationName'] = 'Bilde'
+            listed_observations.append(p)
+
+    return listed_observations
+
+
+def _get_high_water_mark(nested_observations):
+    """The last time any of the registrations were made or changed. Registrations made or changed later are not
+    in the data set.
+
+    :param nested_observations: [list of Observation]
+    :return:                    [datetime] or None if there are no registrations
+    """
+
+    return max((o.DtChangeTime or o.DtRegTime for o in nested_observations), default=None)
+
+
+def _sync_observations(nested_observations, from_date, to_date, lang_key=1, overlap=dt.timedelta(hours=1)):
+    """Brings a stored set of registrations up to date. Registrations made or changed since the high-water mark are
+    requested and replace those with the same RegID. Registrations deleted since are taken out.
+
+    The high-water mark is moved back by the overlap, so registrations saved at the same time as the last sync
+    are not missed. Registrations got again are replaced, so the overlap does no harm.
+
+    If any registration got was made or changed before the time asked for, the webapi has not filtered on the time
+    of change. Then None is returned and the whole season is requested, rather than merging what may be anything.
+
+    :param nested_observations: [list of Observation] The stored registrations.
+    :param from_date:           [date] Start of the season.
+    :param to_date:             [date] End of the season.
+    :param lang_key             [int] 1 is norwegian, 2 is english
+    :param overlap:             [timedelta]
+    :return:                    [list of Observation] sorted on DtObsTime, or None if a sync was not possible and
+                                all must be requested.
+    """
+
+    high_water_mark = _get_high_water_mark(nested_observations)
+    if high_water_mark is None:
+        return None
+
+    changed_since = high_water_mark - overlap
+
+    try:
+        deleted_reg_ids = gm.get_deleted_reg_ids(changed_since)
+    except Exception:
+        error_msg = sys.exc_info()[0]
+        ml.log_and_print('[warning] getvarsompickles.py -> _sync_observations: Could not get deleted registrations: {0}'
+                         .format(error_msg))
+        return None
+
+    try:
+        changed_observations = go.get_data_as_class(from_date=from_date, to_date=to_date, output='Nest',
+                                                    geohazard_tids=None, lang_key=lang_key,
+                                                    changed_since=changed_since)
+    except ConnectionError:
+        error_msg = sys.exc_info()[1]
+        ml.log_and_print('[warning] getvarsompickles.py -> _sync_observations: Could not get changed registrations: '
+                         '{0}'.format(error_msg))
+        return None
+
+    not_changed = [o.RegID for o in changed_observations if (o.DtChangeTime or o.DtRegTime) < changed_since]
+    if not_changed:
+        ml.log_and_print('[warning] getvarsompickles.py -> _sync_observations: {0} registrations got were not changed '
+                         'since {1}, eg. RegID {2}. The webapi did not filter on the time of change. Requesting all.'
+                         .format(len(not_changed), changed_since, not_changed[0]))
+        return None
+
+    observations_by_reg_id = {o.RegID: o for o in nested_observations}
+    for o in changed_observations:
+        observations_by_reg_id[o.RegID] = o
+    for reg_id in deleted_reg_ids:
+        observations_by_reg_id.pop(reg_id, None)
+
+    ml.log_and_print('[info] getvarsompickles.py -> _sync_observations: {0} made or changed and {1} deleted since {2}'
+                     .format(len(changed_observations), len(deleted_reg_ids), changed_since))
+
+    return sorted(observations_by_reg_id.values(), key=lambda o: o.DtObsTime)
+
+
+def _get_current_season():
+    """If we are well out of the current season (30 days) its little chance the data set has changed. The season
+    30 days ago is taken as the current."""
+
+    return gm.get_season_from_date(dt.date.today() - dt.timedelta(30))
+
+
+def _is_stored(file_name, year, max_file_age, min_file_size=100):
+    """Tests if a season is stored in a file which may be used. Previous seasons are always used. The current
+    season is used if the file is newer than max_file_age and larger than min_file_size.
+
+    :param file_name:       [string] File holding the season.
+    :param year:            [string] Eg. season '2017-18'
+    :param max_file_age:    [int] hrs how old the file is before new is retrieved
+    :param min_file_size:   [int] bytes. A pickle smaller than 100 bytes is nearly empty.
+    :return:                [bool]
+    """
+
+    if os.path.exists(file_name):
+        # if file contains a season long gone, dont make new.
+        if year == _get_current_season():
+            date_limit = dt.datetime.now() - dt.timedelta(hours=max_file_age)
+            file_age = dt.datetime.fromtimestamp(os.path.getmtime(file_name))
+            # If file is newer than the given time limit, dont make new.
+            if file_age > date_limit:
+                # If file size larger than that of an nearly empty file, dont make new.
+                if os.path.getsize(file_name) > min_file_size:
+                    return True
+        else:
+            return True
+
+    return False
+
+
+def _file_name_nest(year, lang_key):
+    return '{0}all_observations_nest_{1}_lk{2}.pickle'.format(env.local_storage, year, lang_key)
+
+
+def _get_new_observations(year, lang_key=1, incremental=False):
+    """Part of get_all_observations. Requests the season, or only what is new if incremental, and pickles it.
+
+    :return:    [list of Observation]
+    """
+
+    from_date, to_date = gm.get_dates_from_season(year=year)
+    file_name_nest = _file_name_nest(year, lang_key)
+    nested_observations = None
+
+    if incremental and year == _get_current_season() and os.path.exists(file_name_nest):
+        nested_observations = _sync_observations(mp.unpickle_anything(file_name_nest), from_date, to_date,
+                                                 lang_key=lang_key)
+
+    if nested_observations is None:
+        # When get new, get all geo hazards. A season is requested month by month in parallel.
+        try:
+            nested_observations = go.get_data_as_class(from_date=from_date, to_date=to_date, output='Nest',
+                                                       geohazard_tids=None, lang_key=lang_key, shard_by='month')
+        except ConnectionError:
+            # The stored season is better than none. If none is stored, the caller gets the error.
+            if not os.path.exists(file_name_nest):
+                raise
+            nested_observations = []
+
+    # A season with no observations is taken as a failed request.
+    if len(nested_observations) == 0 and os.path.exists(file_name_nest):
+        ml.log_and_print('[warning] getvarsompickles.py -> _get_new_observations: No observations got for {0}. Keeping '
+                         'the stored.'.format(year))
+        return mp.unpickle_anything(file_name_nest)
+
+    mp.pickle_anything(nested_observations, file_name_nest)
+
+    # The list used to be pickled as well. It is now made from the nest.
+    file_name_list = '{0}all_observations_list_{1}_lk{2}.pickle'.format(env.local_storage, year, lang_key)
+    if os.path.exists(file_name_list):
+        os.remove(file_name_list)
+
+    return nested_observations
+
+
+def _refresh_observations(year, lang_key=1, incremental=False):
+    """Part of get_all_observations. Run in the background by makerefresh. Requests the season and replaces the
+    stored. The pickle is replaced in one move, so it is the old or the new and never a half written. If the
+    request fails, the old is kept."""
+
+    file_name_nest = _file_name_nest(year, lang_key)
+
+    try:
+        _get_new_observations(year, lang_key, incremental)
+
+    except Exception:
+        error_msg = sys.exc_info()[0]
+        ml.log_and_print('[warning] getvarsompickles.py -> _refresh_observations: Could not refresh {0}. Keeping the '
+                         'old. {1}'.format(file_name_nest, error_msg))
+
+
+def get_all_observations(year, output='Nest', geohazard_tids=None, lang_key=1, max_file_age=23, compact=False,
+                         incremental=False, refresh_in_background=False):
     """Specialized method for getting all observations for one season (1. sept to 31. august).
     For the current season (at the time of writing, 2018-19), if request has been made the last 23hrs,
     data is retrieved from a locally stored pickle, if not, new request is made to the regObs api. Previous
     seasons are not requested if a pickle is found in local storage.
 
+    Only the nested observations are pickled. The 'List' output is made from them when requested.
+
     :param year:                [string] Eg. season '2017-18' (sept-sept) or one single year '2018'
     :param output:              [string] 'Nest' or 'List'
     :param geohazard_tids:      [int or list of ints] Default None gives all. Note, pickle stores all, but this option returns a select
     :param lang_key             [int] 1 is norwegian, 2 is english
     :param max_file_age:        [int] hrs how old the file is before new is retrieved
+    :param compact:             [bool] If True, observations are returned as CompactObservation without the raw
+                                data from the api. Uses much less memory, eg. when holding several seasons. Note,
+                                the season is unpickled to the full classes before it is made compact, so the peak
+                                memory use while getting one season is the same as with compact=False.
+    :param incremental:         [bool] If True, and the current season is stored but older than max_file_age, only
+                                registrations made, changed or deleted since the last request are requested and
+                                merged with those stored. If False, the whole season is requested again.
+    :param refresh_in_background:   [bool] If True, and the current season is stored but older than max_file_age,
+                                the stored season is returned at once and a new is requested in a background thread.
+                                The new replaces the stored when got. If the api is down, the stored is kept. The
+                                thread does not keep the process from exiting, and a refresh not done by then is
+                                tried again the next time.
 
     :return:
     """
 
-    from_date, to_date = gm.get_dates_from_season(year=year)
-    file_name_list = '{0}all_observations_list_{1}_lk{2}.pickle'.format(env.local_storage, year, lang_key)
-    file_name_nest = '{0}all_observations_nest_{1}_lk{2}.pickle'.format(env.local_storage, year, lang_key)
-    get_new = True
-    date_limit = dt.datetime.now() - dt.timedelta(hours=max_file_age)
+    file_name_nest = _file_name_nest(year, lang_key)
+    get_new = not _is_stored(file_name_nest, year, max_file_age)
 
-    # if we are well out of the current season (30 days) its little chance the data set has changed.
-    current_season = gm.get_season_from_date(dt.date.today() - dt.timedelta(30))
+    if output not in ['Nest', 'List']:
+        ml.log_and_print('[warning] getvarsompickles.py -> get_all_registrations: Unknown output option')
+        return []
 
     if geohazard_tids:
         if not isinstance(geohazard_tids, list):
             geohazard_tids = [geohazard_tids]
 
-    if os.path.exists(file_name_list):
-        # if file contains a season long gone, dont make new.
-        if year == current_season:
-            file_age = dt.datetime.fromtimestamp(os.path.getmtime(file_name_list))
-            # If file is newer than the given time limit, dont make new.
-            if file_age > date_limit:
-                # If file size larger than that of an nearly empty file, dont make new.
-                if os.path.getsize(file_name_list) > 100:   # 100 bytes limit
-                    get_new = False
-        else:
-            get_new = False
+    if get_new and refresh_in_background and os.path.exists(file_name_nest):
+        # Use the old while the new is requested.
+        mrf.refresh_in_background(file_name_nest, _refresh_observations, (year, lang_key, incremental))
+        nested_observations = mp.unpickle_anything(file_name_nest)
+
+    elif get_new:
+        nested_observations = _get_new_observations(year, lang_key, incremental)
 
-    if get_new:
-        # When get new, get all geo hazards
-        nested_observations = go.get_data_as_class(from_date=from_date, to_date=to_date,
-                                                   output='Nest', geohazard_tids=None, lang_key=lang_key)
+    else:
+        nested_observations = mp.unpickle_anything(file_name_nest)
 
-        mp.pickle_anything(nested_observations, file_name_nest)
+    if geohazard_tids:
+        nested_observations = [o for o in nested_observations if o.GeoHazardTID in geohazard_tids]
 
-        listed_observations = []
-        for d in nested_observations:
-            for o in d.Observations:
-                if _observation_is_not_empty(o):
-                    listed_observations.append(o)
-            for p in d.Pictures:
-                # p['RegistrationName'] = 'Bilde'
-                listed_observations.append(p)
+    # Only the nest is stored. The list is made from it and refers to the same forms and pictures.
+    if output == 'List':
+        observations = _make_listed_observations(nested_observations)
+    else:
+        observations = nested_observations
 
-        mp.pickle_anything(listed_observations, file_name_list)
+    if compact:
+        observations = [go.compact_observation(o) for o in observations]
 
-    if output == 'Nest':
-        all_nested_observations = mp.unpickle_anything(file_name_nest)
-        nested_observations = []
+    return observations
 
-        if geohazard_tids:
-            for o in all_nested_observations:
-                if o.GeoHazardTID in geohazard_tids:
-                    nested_observations.append(o)
 
-        else:
-            nested_observations = all_nested_observations
+def _season_store_folder(year, lang_key):
+    return '{0}seasons/{1}_lk{2}/'.format(env.local_storage, year, lang_key)
 
-        return nested_observations
 
-    elif output == 'List':
-        all_listed_observations = mp.unpickle_anything(file_name_list)
-        listed_observations = []
+def _make_storable_column(values):
+    """Part of _make_partition_frame. Columns of strings are stored as they are. Columns of bools or numbers with
+    missing values are stored with the nullable pandas dtypes, so they are read back as they went in. Columns of
+    lists, dicts or other objects are left out and None is returned. These are found on the classes made from
+    OriginalData. Columns mixing strings and numbers are stored as strings."""
 
-        if geohazard_tids:
-            for o in all_listed_observations:
-                if o.GeoHazardTID in geohazard_tids:
-                    listed_observations.append(o)
+    import pandas as pd
 
-        else:
-            listed_observations = all_listed_observations
+    not_none = [v for v in values if v is not None]
 
-        return listed_observations
+    if any(isinstance(v, (list, tuple, dict)) or hasattr(v, '__dict__') for v in not_none):
+        return None
 
-    else:
-        ml.log_and_print('[warning] getvarsompickles.py -> get_all_registrations: Unknown output option')
+    if all(isinstance(v, str) for v in not_none):
+        return values
+
+    if all(isinstance(v, bool) for v in not_none):
+        return pd.array(values, dtype='boolean')
+
+    if all(isinstance(v, (int, float)) and not isinstance(v, bool) for v in not_none):
+        return pd.array(values, dtype='Float64')
+
+    return [None if v is None else str(v) for v in values]
+
+
+def _make_partition_frame(observations):
+    """Makes the data frame stored for one partition. There is one column pr attribute on the classes and the
+    form as given by the webapi is kept as json in the column OriginalData, so the classes may be made again.
+
+    :param observations:    [list of observations] Forms or pictures of the same type.
+    :return:                [DataFrame]
+    """
+
+    data_frame = go._make_data_frame(observations)
+    data_frame = data_frame.drop(columns=[c for c in ['OriginalData', 'FullObject'] if c in data_frame.columns])
+
+    for column in list(data_frame.columns):
+        if data_frame[column].dtype == object:
+            values = _make_storable_column(data_frame[column].tolist())
+            if values is None:
+                data_frame = data_frame.drop(columns=[column])
+            else:
+                data_frame[column] = values
+
+    # Only the form and the registration it is part of are kept. Other forms in the same registration are not.
+    original_data = []
+    for o in observations:
+        form = {k: v for k, v in o.OriginalData.items() if k != 'Registrations'}
+        original_data.append(json.dumps(form))
+
+    data_frame['OriginalData'] = original_data
+
+    return data_frame
+
+
+def _write_season_store(nested_observations, folder):
+    """Writes a season to a columnar store with one Feather file pr geo hazard and registration type. Files are
+    uncompressed so they may be memory mapped when read. partitions.json, listing the files, is written last and
+    its time of change is the age of the store.
+
+    :param nested_observations: [list of Observation]
+    :param folder:              [string] Folder of the store. Files there from before are replaced.
+    """
+
+    import pyarrow.feather as feather
+
+    partitions = {}
+    for o in _make_listed_observations(nested_observations):
+        key = (o.GeoHazardTID, _registration_tids[o.__class__])
+        partitions.setdefault(key, []).append(o)
+
+    os.makedirs(folder, exist_ok=True)
+    for file_name in os.listdir(folder):
+        os.remove('{0}{1}'.format(folder, file_name))
+
+    file_names = []
+    for (geohazard_tid, registration_tid), observations in sorted(partitions.items()):
+        file_name = 'gh{0}_rt{1}.feather'.format(geohazard_tid, registration_tid)
+        feather.write_feather(_make_partition_frame(observations), '{0}{1}'.format(folder, file_name),
+                              compression='uncompressed')
+        file_names.append(file_name)
+
+    with open('{0}partitions.json'.format(folder), 'w') as f:
+        json.dump(file_names, f)
+
+    ml.log_and_print('[info] getvarsompickles.py -> _write_season_store: {0} partitions written to {1}'
+                     .format(len(file_names), folder))
+
+
+def get_season_from_store(year, geohazard_tids=None, registration_types=None, columns=None, output='DataFrame',
+                          lang_key=1, max_file_age=23, memory_map=True):
+    """Gets observations for one season from a columnar store in local storage. The store is partitioned on geo
+    hazard and registration type, and only the partitions and columns needed are read. Eg. snow danger signs for
+    2017-18 is read without reading any water levels.
+
+    The store is made from the season as given by get_all_observations, and is made again when it is older than
+    max_file_age in the current season.
+
+    Requires pyarrow:
+    pip install pyarrow
+
+    :param year:                [string] Eg. season '2017-18' (sept-sept) or one single year '2018'
+    :param geohazard_tids:      [int or list of ints] Default None gives all.
+    :param registration_types:  [int or list of ints] RegistrationTIDs as in _registration_classes. 12 is pictures.
+                                Default None gives all.
+    :param columns:             [list of strings] Columns in the data frame. Default None gives all but OriginalData.
+                                Not used when output is 'List'. Bools and numbers are read as they went in, with
+                                the nullable pandas dtypes where values are missing. Note, columns mixing strings
+                                and numbers (eg. a value given as 2 on one form and '2-3' on another) are stored as
+                                strings, so in the data frame they are strings where the classes have numbers. Columns of lists,
+                                dicts or objects are not stored. The classes made with output 'List' have the values
+                                as given by the api.
+    :param output:              [string] 'DataFrame' or 'List'. 'List' makes the observations to their classes again.
+    :param lang_key             [int] 1 is norwegian, 2 is english
+    :param max_file_age:        [int] hrs how old the store is before new is made
+    :param memory_map:          [bool] If True, files are memory mapped and not read to memory before used.
+
+    :return:                    [DataFrame or list of observations] sorted on DtObsTime.
+
+    Ex of use:  danger_signs = get_season_from_store('2017-18', geohazard_tids=10, registration_types=13)
+    """
+
+    import pandas as pd
+    import pyarrow as pa
+    import pyarrow.feather as feather
+    import pyarrow.ipc as ipc
+
+    if output not in ['DataFrame', 'List']:
+        ml.log_and_print('[warning] getvarsompickles.py -> get_season_from_store: Unknown output option')
         return []
 
+    # If input isn't a list, make it so
+    if geohazard_tids is not None and not isinstance(geohazard_tids, list):
+        geohazard_tids = [geohazard_tids]
+
+    if registration_types is not None and not isinstance(registration_types, list):
+        registration_types = [registration_types]
+
+    folder = _season_store_folder(year, lang_key)
+    file_name_partitions = '{0}partitions.json'.format(folder)
+
+    # partitions.json is small when there are few partitions. Its age alone tells if the store is fresh.
+    if not _is_stored(file_name_partitions, year, max_file_age, min_file_size=0):
+        nested_observations = get_all_observations(year, output='Nest', lang_key=lang_key, max_file_age=max_file_age)
+        _write_season_store(nested_observations, folder)
+
+    with open(file_name_partitions) as f:
+        file_names = json.load(f)
+
+    tables = []
+    for file_name in file_names:
+        geohazard_tid, registration_tid = [int(k[2:]) for k in file_name[:-len('.feather')].split('_')]
+
+        if geohazard_tids is not None and geohazard_tid not in geohazard_tids:
+            continue
+        if registration_types is not None and registration_tid not in registration_types:
+            continue
+
+        file_name = '{0}{1}'.format(folder, file_name)
+        if output == 'List':
+            table = feather.read_table(file_name, columns=['OriginalData'], memory_map=memory_map)
+            tables.append((registration_tid, table))
+        else:
+            read_columns = None
+            if columns is not None:
+                # The file is closed when the names are read. Windows does not let open files be replaced.
+                with pa.memory_map(file_name) as source:
+                    names = ipc.open_file(source).schema.names
+                read_columns = [c for c in columns if c in names]
+            table = feather.read_table(file_name, columns=read_columns, memory_map=memory_map)
+            tables.append((registration_tid, table))
+
+    if output == 'List':
+        observations = []
+        for registration_tid, table in tables:
+            registration_class = go._registration_classes[registration_tid]
+            observations += [registration_class(json.loads(d)) for d in table.column('OriginalData').to_pylist()]
+
+        return sorted(observations, key=lambda o: o.DtObsTime)
+
+    data_frames = [table.to_pandas() for registration_tid, table in tables]
+    if columns is None:
+        data_frames = [df.drop(columns=['OriginalData']) for df in data_frames]
+
+    if len(data_frames) == 0:
+        return pd.DataFrame()
+
+    data_frame = pd.concat(data_frames, ignore_index=True)
+    if 'DtObsTime' in data_frame.columns:
+        data_frame = data_frame.sort_values('DtObsTime', kind='mergesort', ignore_index=True)
+
+    return data_frame
+
 
 if __name__ == "__main__":
 
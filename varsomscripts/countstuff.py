@@ -81,14 +81,12 @@ def _map_obs_to_old_regions(obs, make_new=True):
 
     if make_new:
 
-        for o in obs:
-            utm_n = o.UTMNorth
-            utm_e = o.UTMEast
-            date = o.DtObsTime
-            year = gm.get_season_from_date(date)
-            region_id, region_name = gm.get_forecast_region_for_coordinate(utm_e, utm_n, year)
+        region_ids, region_names = gm.get_forecast_regions_for_coordinates(
+            [o.UTMEast for o in obs], [o.UTMNorth for o in obs], [o.DtObsTime for o in obs])
+
+        for o, region_id, region_name in zip(obs, region_ids, region_names):
             o.ForecastRegionName = region_name
-            o.ForecastRegionTID = region_id
+            o.ForecastRegionTID = int(region_id)
 
         mp.pickle_anything(obs, picle_file_name)
         return obs
@@ -105,7 +103,7 @@ def write_to_file_all_obs():
     years = ['2012-13', '2013-14', '2014-15', '2015-16', '2016-17', '2017-18', '2018-19']
     all_observations = []
     for y in years:
-        all_observations += gvp.get_all_observations(y)
+        all_observations += gvp.get_all_observations(y, compact=True)
 
     num_at_date = _make_date_obscount_dict()          # number of obs pr day pr geohazard
 
@@ -481,8 +479,8 @@ def total_2018_and_part_water():
     
     for y in years:
         
-        all_observations = gvp.get_all_observations(y)
-        all_forms = gvp.get_all_observations(y, output='List')
+        all_observations = gvp.get_all_observations(y, compact=True)
+        all_forms = gvp._make_listed_observations(all_observations)
 
         all_water_forms = [f for f in all_forms if f.GeoHazardTID == 60 and not isinstance(f, go.PictureObservation)]
         all_water_pictures = [f for f in all_forms if f.GeoHazardTID == 60 and isinstance(f, go.PictureObservation)]
@@ -177,13 +177,14 @@ def plot_numbers_of_3_seasons(output_folder=env.plot_folder+'regobsplots/'):
     TODO: get the x-axis right
     """
 
-    # Get data
-    all_obs_201819_list = gvp.get_all_observations('2018-19', output='List', max_file_age=23)
-    all_obs_201819_nest = gvp.get_all_observations('2018-19', output='Nest', max_file_age=23)
-    all_obs_201718_list = gvp.get_all_observations('2017-18', output='List')
-    all_obs_201718_nest = gvp.get_all_observations('2017-18', output='Nest')
-    all_obs_201617_list = gvp.get_all_observations('2016-17', output='List')
-    all_obs_201617_nest = gvp.get_all_observations('2016-17', output='Nest')
+    # Get data. Three seasons are held in memory at once, so they are made compact and the lists are made from
+    # the nested registrations, not requested again.
+    all_obs_201819_nest = gvp.get_all_observations('2018-19', output='Nest', max_file_age=23, compact=True)
+    all_obs_201819_list = gvp._make_listed_observations(all_obs_201819_nest)
+    all_obs_201718_nest = gvp.get_all_observations('2017-18', output='Nest', compact=True)
+    all_obs_201718_list = gvp._make_listed_observations(all_obs_201718_nest)
+    all_obs_201617_nest = gvp.get_all_observations('2016-17', output='Nest', compact=True)
+    all_obs_201617_list = gvp._make_listed_observations(all_obs_201617_nest)
 
     # Make dict with all dates and a empty DailyNumbers object
     all_year = {}